@@ -0,0 +1,84 @@
+"""
+Startup benchmark for the dashboards
+
+`panel serve` executes a dashboard script for every new session, so the time taken
+to run the script is the server-side part of the time-to-first-paint of a session.
+For each dashboard this reports:
+
+- cold: the first session of a fresh server process (includes all imports)
+- warm: later sessions of the same process (after common.warm_up() has finished)
+
+Usage (from the root of SwarmPAL-processor):
+    uv run python benchmarks/dashboard_startup.py [--repeat 5] [dashboards/FAC.py ...]
+"""
+
+import argparse
+from pathlib import Path
+import runpy
+import statistics
+import subprocess
+import sys
+import time
+
+DASHBOARD_DIR = Path(__file__).parent.parent / "dashboards"
+DASHBOARDS = [
+    DASHBOARD_DIR / "FAC.py",
+    DASHBOARD_DIR / "MMA.py",
+    DASHBOARD_DIR / "file-demo.py",
+]
+
+
+def run_session(script):
+    """Execute a dashboard script the way the server does for a new session, returning the time taken (s)"""
+    from bokeh.document import Document
+    from panel.io.state import set_curdoc
+
+    if str(DASHBOARD_DIR) not in sys.path:
+        sys.path.insert(0, str(DASHBOARD_DIR))
+    t0 = time.perf_counter()
+    with set_curdoc(Document()):
+        runpy.run_path(str(script), run_name="bokeh_app_benchmark")
+    return time.perf_counter() - t0
+
+
+def time_cold_session(script):
+    """Time the first session in a fresh interpreter"""
+    output = subprocess.run(
+        [sys.executable, __file__, "--cold", str(script)],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def time_warm_sessions(script, repeat):
+    """Time sessions after the first one, once the warm-up has completed"""
+    run_session(script)
+    from common import warm_up
+
+    warm_up().join()
+    return [run_session(script) for _ in range(repeat)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scripts", nargs="*", type=Path, default=DASHBOARDS)
+    parser.add_argument("--repeat", type=int, default=5, help="Number of warm sessions to time")
+    parser.add_argument("--cold", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.cold:
+        # Child process: report a single cold session
+        print(run_session(args.scripts[0]))
+        return
+
+    print(f"{'dashboard':<16}{'cold (s)':>12}{'warm median (s)':>18}{'warm max (s)':>15}")
+    for script in args.scripts:
+        cold = time_cold_session(script)
+        warm = time_warm_sessions(script, args.repeat)
+        print(f"{script.stem:<16}{cold:>12.3f}{statistics.median(warm):>18.3f}{max(warm):>15.3f}")
+
+
+if __name__ == "__main__":
+    main()
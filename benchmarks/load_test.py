@@ -0,0 +1,507 @@
+"""
+Load test for the dashboards with concurrent sessions
+
+Starts `panel serve` with the FAC, MMA and file-demo dashboards, as in production, and
+a compute service whose workers read canned data instead of fetching from VirES (see
+vires_standin.py), so the results depend neither on the network nor on the load on
+VirES. Each simulated user then opens real sessions on the server with the Bokeh client
+(over the websocket, as a browser does) and goes through the flows of each dashboard,
+changing the widgets and clicking the buttons. An action is timed from when the client
+sends it until the server has sent back the update showing its result (the rendering in
+a browser is not included). Each user runs in its own process, so that the clients do
+not slow each other down.
+
+Record the canned data once (needs VirES access, see the README):
+    uv run python benchmarks/load_test.py record --start 2024-01-01 --end 2024-01-03
+
+Then run the test (from the root of SwarmPAL-processor), e.g. with 20 users:
+    uv run python benchmarks/load_test.py run --sessions 20
+
+Reports the latency of each action (p50/p95/p99), how many were refused by the compute
+service (queue limits) or failed, and the memory and CPU used by the panel server and by
+the compute service (with its workers).
+"""
+
+import argparse
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import datetime as dt
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import re
+import secrets
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+
+DASHBOARD_DIR = Path(__file__).parent.parent / "dashboards"
+DASHBOARDS = ["FAC.py", "MMA.py", "file-demo.py"]
+STANDIN_DIR = Path(__file__).parent / "vires-standin"
+# Canned collections (FAC uses Swarm A, MMA uses Swarm A and B), with everything the dashboards ask for
+STANDIN_COLLECTIONS = ["SW_OPER_MAGA_LR_1B", "SW_OPER_MAGB_LR_1B"]
+STANDIN_MEASUREMENTS = ["B_NEC", "Flags_F", "Flags_B", "Flags_q"]
+STANDIN_MODELS = ["CHAOS", "CHAOS-Core"]
+# File used for the upload flows
+UPLOAD_COLLECTION = "SW_OPER_MAGA_LR_1B"
+SERVER_PORT = 5056
+COMPUTE_PORT = 50056
+SAMPLE_INTERVAL = 0.5
+# Shown by the dashboards when the compute service refuses or fails a job (see common.run_job)
+REFUSED_MESSAGES = ("evaluations in progress", "The server is busy")
+FAILED_MESSAGE = "The evaluation failed"
+
+
+# Canned data
+
+def record(directory, start, end):
+    """Fetch the canned data from VirES, and write the file used for the uploads"""
+    from swarmpal.io import PalDataItem, create_paldata
+
+    directory.mkdir(parents=True, exist_ok=True)
+    for collection in STANDIN_COLLECTIONS:
+        print(f"Fetching {collection}: {start} to {end}")
+        item = PalDataItem.from_vires(
+            collection=collection,
+            measurements=STANDIN_MEASUREMENTS,
+            models=STANDIN_MODELS,
+            start_time=start.isoformat(),
+            end_time=end.isoformat(),
+            server_url="https://vires.services/ows",
+            options=dict(asynchronous=False, show_progress=False),
+        )
+        ds = item.xarray
+        # netCDF attributes cannot hold empty lists or None
+        for attrs in [ds.attrs] + [ds[name].attrs for name in ds.variables]:
+            for key in [key for key, value in attrs.items() if value is None or (isinstance(value, list) and not value)]:
+                del attrs[key]
+        ds.to_netcdf(directory / f"{collection}.nc")
+        if collection == UPLOAD_COLLECTION:
+            create_paldata(**{collection: item}).swarmpal.to_cdf(str(directory / upload_name(start, end)), leaf=collection)
+    with open(directory / "window.json", "w") as file:
+        json.dump({"start": start.isoformat(), "end": end.isoformat()}, file)
+
+
+def upload_name(start, end):
+    """Name of the file used for the uploads, following the product naming"""
+    t_end = end - dt.timedelta(seconds=1)
+    return f"{UPLOAD_COLLECTION}_{start:%Y%m%dT%H%M%S}_{t_end:%Y%m%dT%H%M%S}_0000.cdf"
+
+
+def load_window(directory):
+    with open(directory / "window.json") as file:
+        window = json.load(file)
+    return dt.datetime.fromisoformat(window["start"]), dt.datetime.fromisoformat(window["end"])
+
+
+# Sessions
+
+class Page:
+    """A session of a dashboard on the server, driven through the Bokeh client as a browser would"""
+
+    def __init__(self, url):
+        from bokeh.client import pull_session
+        # The Panel models must be known to read the document
+        import panel.models  # noqa: F401
+        import panel.models.file_dropper  # noqa: F401
+
+        self.session = pull_session(url=url)
+        self.document = self.session.document
+        # The models all exist on the server, so only send references to them with the changes
+        self.document.models.flush_synced()
+        # (model, attribute, new value) of the changes made by the server since the start of the current action
+        self.updates = []
+        self.document.on_change(self._record_update)
+
+    def _record_update(self, event):
+        if event.setter is self.session and hasattr(event, "attr"):
+            self.updates.append((event.model, event.attr, event.new))
+
+    def models(self, type_name):
+        return [
+            model for root in self.document.roots for model in root.references()
+            if type(model).__name__ == type_name
+        ]
+
+    def find(self, type_name, **properties):
+        """The model of a widget, given its Bokeh type and some of its properties (e.g. its label)"""
+        for model in self.models(type_name):
+            if all(getattr(model, name) == value for name, value in properties.items()):
+                return model
+        raise LookupError(f"No {type_name} with {properties} in {self.session.url}")
+
+    def select(self, type_name, *labels):
+        """Select options of a RadioGroup or CheckboxGroup by their labels"""
+        model = next(model for model in self.models(type_name) if set(labels) <= set(model.labels))
+        indices = [model.labels.index(label) for label in labels]
+        model.active = indices[0] if type_name == "RadioGroup" else indices
+
+    def set_range(self, t_start, t_end):
+        """Set the DatetimeRangePicker of the page"""
+        self.find("DatetimePicker").value = f"{t_start:%Y-%m-%d %H:%M:%S} to {t_end:%Y-%m-%d %H:%M:%S}"
+
+    def send_event(self, event):
+        """Send a UI event (e.g. a button click) to the server"""
+        from bokeh.document.events import MessageSentEvent
+
+        self.document.callbacks.trigger_on_change(MessageSentEvent(self.document, "bokeh_event", event))
+
+    def click(self, label):
+        from bokeh.events import ButtonClick
+
+        self.send_event(ButtonClick(self.find("Button", label=label)))
+
+    def upload(self, path):
+        """Drop a file on the FileDropper of the page, sent in chunks as the browser does"""
+        from panel.models.file_dropper import UploadEvent
+
+        model = self.find("FileDropper")
+        content = path.read_bytes()
+        chunks = [content[i:i + model.chunk_size] for i in range(0, len(content), model.chunk_size)]
+        for number, chunk in enumerate(chunks, 1):
+            data = dict(name=path.name, chunk=number, total_chunks=len(chunks), type="application/octet-stream", data=chunk)
+            event = UploadEvent(model, data=data)
+            # (only the values of an event are sent)
+            event.event_values = lambda data=data: dict(model=model, data=data)
+            self.send_event(event)
+
+    def updated(self, model, attr, value):
+        """Whether the server has set a property of a model to value since the start of the current action"""
+        return any(m is model and a == attr and new == value for m, a, new in self.updates)
+
+    def shown(self, text):
+        """Whether the server has shown text in a pane since the start of the current action"""
+        return any(a == "text" and isinstance(new, str) and text in new for _, a, new in self.updates)
+
+    def job_outcome(self):
+        """Whether the dashboard has shown that the job of the current action was refused or failed ("ok" if neither)"""
+        if self.shown(FAILED_MESSAGE):
+            return "failed"
+        if any(self.shown(message) for message in REFUSED_MESSAGES):
+            return "refused"
+        return "ok"
+
+    def wait_until(self, predicate, timeout):
+        """Apply the updates from the server until predicate() is true, raising TimeoutError after timeout (s)"""
+        # ClientSession only offers a blocking loop until the session is closed, and
+        # force_roundtrip() drops the updates which arrive while it waits for its reply
+        connection = self.session._connection
+        loop = connection.io_loop
+        timer = loop.call_later(timeout, loop.stop)
+        try:
+            connection._loop_until(predicate)
+        finally:
+            loop.remove_timeout(timer)
+        if not predicate():
+            raise TimeoutError(f"No response within {timeout:g} s")
+
+    def close(self):
+        self.session.close()
+
+
+class Results:
+    """Latencies and outcomes of the actions of the sessions"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.outcomes = defaultdict(Counter)
+        self.errors = {}
+
+    def add(self, action, outcome, latency=None, error=None):
+        self.outcomes[action][outcome] += 1
+        if outcome == "ok":
+            self.latencies[action].append(latency)
+        if error:
+            self.errors[action] = error
+
+    def update(self, other):
+        for action, outcomes in other.outcomes.items():
+            self.outcomes[action].update(outcomes)
+            self.latencies[action].extend(other.latencies[action])
+        self.errors.update(other.errors)
+
+    def open_page(self, action, url):
+        """Time opening a new session of a dashboard, returning its Page (None if it failed)"""
+        t0 = time.perf_counter()
+        try:
+            page = Page(url)
+        except Exception as e:
+            self.add(action, "failed", error=f"{type(e).__name__}: {e}")
+            return None
+        self.add(action, "ok", time.perf_counter() - t0)
+        return page
+
+    def act(self, action, page, send, done, timeout):
+        """Time an action: send() sends it, and it has completed once done() is true (or its job was refused or failed)
+
+        Returns whether it succeeded.
+        """
+        page.updates.clear()
+        t0 = time.perf_counter()
+        try:
+            send()
+            page.wait_until(lambda: done() or page.job_outcome() != "ok", timeout)
+        except Exception as e:
+            self.add(action, "failed", error=f"{type(e).__name__}: {e}")
+            return False
+        latency = time.perf_counter() - t0
+        outcome = page.job_outcome()
+        error = None
+        if outcome == "failed":
+            error = next(re.sub(r"<[^>]+>", "", new) for _, a, new in page.updates if a == "text" and FAILED_MESSAGE in new)
+        self.add(action, outcome, latency, error)
+        return outcome == "ok"
+
+
+def fac_flow(results, base_url, window, upload_file, timeout):
+    page = results.open_page("FAC: open page", f"{base_url}/FAC")
+    if page is None:
+        return
+    try:
+        page.select("RadioGroup", "Swarm-A")
+        # (the canned data is OPER, so the processed FAST files are not used)
+        page.select("RadioGroup", "OPER")
+        page.set_range(*window)
+        evaluate_button = page.find("Button", label="Click to evaluate")
+        results.act(
+            "FAC: evaluate from VirES", page,
+            lambda: page.click("Click to evaluate"),
+            # (re-enabled when the evaluation has ended)
+            lambda: page.updated(evaluate_button, "disabled", False),
+            timeout,
+        )
+        results.act(
+            "FAC: evaluate uploaded file", page,
+            lambda: page.upload(upload_file),
+            lambda: page.shown("Applied local model"),
+            timeout,
+        )
+    finally:
+        page.close()
+
+
+def mma_flow(results, base_url, window, upload_file, timeout):
+    page = results.open_page("MMA: open page", f"{base_url}/MMA")
+    if page is None:
+        return
+    try:
+        page.select("CheckboxGroup", "Swarm-A", "Swarm-B")
+        page.set_range(*window)
+        fetched = results.act(
+            "MMA: fetch inputs", page,
+            lambda: page.click("Fetch inputs"),
+            # (the code snippet is shown once the inputs are fetched)
+            lambda: page.shown("create_paldata"),
+            timeout,
+        )
+        if fetched:
+            results.act(
+                "MMA: run analysis", page,
+                lambda: page.click("Run analysis"),
+                lambda: page.shown("Inputs:"),
+                timeout,
+            )
+    finally:
+        page.close()
+
+
+def file_demo_flow(results, base_url, window, upload_file, timeout):
+    page = results.open_page("file-demo: open page", f"{base_url}/file-demo")
+    if page is None:
+        return
+    try:
+        # (the file is read and shown by the server itself, not by the compute service)
+        results.act(
+            "file-demo: show uploaded file", page,
+            lambda: page.upload(upload_file),
+            lambda: page.shown("xarray.DataTree"),
+            timeout,
+        )
+    finally:
+        page.close()
+
+
+FLOWS = [fac_flow, mma_flow, file_demo_flow]
+
+
+def user(index, base_url, ramp, iterations, window, upload_file, timeout):
+    """One simulated user, going through every flow in turn (run in a process of its own)"""
+    time.sleep(index * ramp)
+    results = Results()
+    for _ in range(iterations):
+        for flow in FLOWS:
+            flow(results, base_url, window, upload_file, timeout)
+    return results
+
+
+# Resource usage
+
+def usage(process):
+    """(RSS in bytes, CPU time in s) of a process and its children"""
+    import psutil
+
+    rss = cpu = 0
+    try:
+        processes = [process] + process.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return rss, cpu
+    for p in processes:
+        try:
+            with p.oneshot():
+                rss += p.memory_info().rss
+                times = p.cpu_times()
+                cpu += times.user + times.system
+        except psutil.NoSuchProcess:
+            pass
+    return rss, cpu
+
+
+def monitor(processes, samples, stop):
+    """Record the usage of each process in samples[name] as (time, RSS, CPU time) until stop is set"""
+    while True:
+        for name, process in processes.items():
+            samples[name].append((time.perf_counter(), *usage(process)))
+        if stop.wait(SAMPLE_INTERVAL):
+            return
+
+
+# Server and compute service
+
+def start_process(name, command, env, port):
+    """Start a process (in a process group of its own) and wait until it is listening on port"""
+    process = subprocess.Popen(command, env=env, start_new_session=True)
+    deadline = time.monotonic() + 120
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                stop_process(process)
+                raise RuntimeError(f"The {name} did not start")
+            time.sleep(0.2)
+
+
+def stop_process(process):
+    """Stop a process started by start_process, with its children"""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.wait()
+
+
+def start_services(workers, standin_directory):
+    """Start the compute service (with the VirES stand-in), then the panel server using it"""
+    env = dict(
+        os.environ,
+        SWARMPAL_COMPUTE_ADDRESS=f"127.0.0.1:{COMPUTE_PORT}",
+        SWARMPAL_COMPUTE_AUTHKEY=secrets.token_hex(32),
+    )
+    compute_service = start_process(
+        "compute service",
+        [sys.executable, str(Path(__file__).parent / "vires_standin.py"), "--workers", str(workers)],
+        dict(env, SWARMPAL_VIRES_STANDIN=str(standin_directory.resolve())),
+        COMPUTE_PORT,
+    )
+    try:
+        server = start_process(
+            "panel server",
+            [
+                sys.executable, "-m", "panel", "serve", *(str(DASHBOARD_DIR / name) for name in DASHBOARDS),
+                "--port", str(SERVER_PORT), "--warm",
+            ],
+            env,
+            SERVER_PORT,
+        )
+    except Exception:
+        stop_process(compute_service)
+        raise
+    return server, compute_service
+
+
+# Report
+
+def report(results, samples, duration):
+    print(f"\n{'action':<32}{'ok':>6}{'refused':>9}{'failed':>8}{'p50 (s)':>10}{'p95 (s)':>10}{'p99 (s)':>10}")
+    for action, outcomes in results.outcomes.items():
+        latencies = results.latencies[action]
+        if latencies:
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            percentiles = f"{p50:>10.3f}{p95:>10.3f}{p99:>10.3f}"
+        else:
+            percentiles = f"{'-':>10}{'-':>10}{'-':>10}"
+        print(f"{action:<32}{outcomes['ok']:>6}{outcomes['refused']:>9}{outcomes['failed']:>8}{percentiles}")
+    print(f"\n{'process':<32}{'peak RSS (MiB)':>16}{'mean CPU (%)':>14}")
+    for name, process_samples in samples.items():
+        t, rss, cpu = np.array(process_samples).T
+        mean_cpu = 100 * (cpu[-1] - cpu[0]) / (t[-1] - t[0]) if len(t) > 1 else 0
+        print(f"{name:<32}{rss.max() / 2**20:>16.0f}{mean_cpu:>14.0f}")
+    print(f"\nTotal time: {duration:.1f} s")
+    for action, error in results.errors.items():
+        print(f"Last error in {action}: {error}")
+
+
+def run(sessions, iterations, ramp, timeout, window, upload_file, server, compute_service):
+    import psutil
+
+    results = Results()
+    samples = defaultdict(list)
+    processes = {
+        "panel server": psutil.Process(server.pid),
+        "compute service and workers": psutil.Process(compute_service.pid),
+    }
+    stop = threading.Event()
+    sampler = threading.Thread(target=monitor, args=(processes, samples, stop), daemon=True)
+    base_url = f"http://localhost:{SERVER_PORT}"
+    with ProcessPoolExecutor(max_workers=sessions, mp_context=multiprocessing.get_context("spawn")) as users:
+        sampler.start()
+        t0 = time.perf_counter()
+        futures = [
+            users.submit(user, i, base_url, ramp, iterations, window, upload_file, timeout) for i in range(sessions)
+        ]
+        for future in futures:
+            results.update(future.result())
+        duration = time.perf_counter() - t0
+    stop.set()
+    sampler.join()
+    report(results, samples, duration)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--standin", type=Path, default=STANDIN_DIR, help="Directory of the canned VirES data")
+    commands = parser.add_subparsers(dest="command", required=True)
+    record_parser = commands.add_parser("record", help="Record the canned data from VirES")
+    record_parser.add_argument("--start", type=dt.datetime.fromisoformat, default=dt.datetime(2024, 1, 1))
+    record_parser.add_argument("--end", type=dt.datetime.fromisoformat, default=dt.datetime(2024, 1, 3))
+    run_parser = commands.add_parser("run", help="Run the load test")
+    run_parser.add_argument("--sessions", type=int, default=10, help="Number of concurrent users")
+    run_parser.add_argument("--iterations", type=int, default=1, help="Number of times each user goes through the flows")
+    run_parser.add_argument("--ramp", type=float, default=1.0, help="Delay between the start of each user (s)")
+    run_parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Number of compute workers")
+    run_parser.add_argument("--timeout", type=float, default=600, help="Time after which an action has failed (s)")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record(args.standin, args.start, args.end)
+        return
+
+    window = load_window(args.standin)
+    upload_file = args.standin / upload_name(*window)
+    server, compute_service = start_services(args.workers, args.standin)
+    try:
+        run(args.sessions, args.iterations, args.ramp, args.timeout, window, upload_file, server, compute_service)
+    finally:
+        stop_process(server)
+        stop_process(compute_service)
+
+
+if __name__ == "__main__":
+    main()
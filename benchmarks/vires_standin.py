@@ -0,0 +1,65 @@
+"""
+Compute service for the load test, with VirES replaced by canned data
+
+Runs the compute service of the dashboards (dashboards/compute.py) with a worker
+initializer which replaces PalDataItem.from_vires by a read of the canned data in the
+directory given by SWARMPAL_VIRES_STANDIN (recorded with `load_test.py record`), so
+that the results depend neither on the network nor on the load on VirES.
+
+Started by load_test.py, as:
+    python benchmarks/vires_standin.py [--workers N]
+"""
+
+import argparse
+import os
+from pathlib import Path
+import sys
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "dashboards"))
+
+import compute  # noqa: E402
+
+
+def from_vires(**params):
+    """Stand-in for PalDataItem.from_vires, reading the canned data of the collection"""
+    import pandas as pd
+    from swarmpal.io import PalDataItem
+    import xarray as xr
+
+    # One file per collection, holding all the measurements and models that may be asked for
+    collection = params["collection"]
+    start_time, end_time = pd.Timestamp(params["start_time"]), pd.Timestamp(params["end_time"])
+    with xr.open_dataset(Path(os.environ["SWARMPAL_VIRES_STANDIN"]) / f"{collection}.nc") as canned:
+        ds = canned.sel(Timestamp=slice(start_time, end_time - pd.Timedelta(1, "ns"))).load()
+    models = params.get("models", [])
+    ds = ds.drop_vars([name for name in ds.data_vars if name.startswith("B_NEC_") and name[len("B_NEC_"):] not in models])
+    if params.get("sampling_step") and ds.sizes["Timestamp"] > 1:
+        cadence = pd.Timedelta(ds["Timestamp"].values[1] - ds["Timestamp"].values[0])
+        ds = ds.isel(Timestamp=slice(None, None, max(round(pd.Timedelta(params["sampling_step"]) / cadence), 1)))
+    item = PalDataItem.from_manual(ds)
+    item.dataset_name = collection
+    item.analysis_window = (start_time.to_pydatetime(), end_time.to_pydatetime())
+    return item
+
+
+def install():
+    """Replace VirES with the canned data (run in each worker process as it starts)"""
+    from swarmpal.io import PalDataItem
+
+    PalDataItem.from_vires = staticmethod(from_vires)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the compute service with the VirES stand-in")
+    parser.add_argument("--workers", type=int, default=compute.MAX_WORKERS, help="Number of worker processes")
+    args = parser.parse_args()
+    if not os.environ.get("SWARMPAL_VIRES_STANDIN"):
+        sys.exit("Set SWARMPAL_VIRES_STANDIN to the directory of the canned data")
+    compute.serve(max_workers=args.workers, worker_initializer=install)
+
+
+if __name__ == "__main__":
+    # Import by name so that the initializer is pickled as vires_standin.install rather than __main__.install
+    import vires_standin
+
+    vires_standin.main()
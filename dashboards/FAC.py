@@ -1,28 +1,38 @@
-import random
+import asyncio
+from functools import partial
+import json
+import math
 import re
-import string
 import datetime as dt
-import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
 import panel as pn
-import hvplot.xarray
 import xarray as xr
-from tempfile import NamedTemporaryFile
-import shutil
 import os
 from pathlib import Path
 
-from swarmpal.io import PalDataItem, create_paldata
-from swarmpal.experimental import LocalForwardMagneticModel
-from swarmpal.toolboxes.fac.processes import FAC_single_sat
 from swarmpal.utils.configs import SPACECRAFT_TO_MAGLR_DATASET
 
-from common import HEADER, JINJA2_ENVIRONMENT, CustomisedFileDropper
+from archive import OVERVIEW_FLAGS_MAX, get_fac_archive
+from common import CDF_EXPORTS, HEADER, JINJA2_ENVIRONMENT, CustomisedFileDropper, DataTreeTable, concat_datatrees, run_job
 
 pn.extension('filedropper')
-xr.set_options(display_expand_groups=True, display_expand_attrs=True, display_expand_data_vars=True, display_expand_coords=True)
 
 FAC_SINGLE_SAT_CODE_TEMPLATE = "fac-single-sat.jinja2"
 
+# Long time ranges are fetched and evaluated one chunk at a time, showing each as it completes
+CHUNK_DURATION = dt.timedelta(days=1)
+# Ranges longer than this (in days) must be confirmed before evaluation, and longer than MAX_DAYS are refused
+CONFIRM_ABOVE_DAYS = float(os.environ.get("SWARMPAL_FAC_CONFIRM_ABOVE_DAYS", 7))
+MAX_DAYS = float(os.environ.get("SWARMPAL_FAC_MAX_DAYS", 90))
+# Used to estimate the cost of a request (MAG LR is at 1 Hz)
+SAMPLES_PER_DAY = 86400
+# The interactive plot shows at most about this many points (the min and max of bins of samples),
+# whatever the length of the range: the data view and the exports keep all the samples
+MAX_PLOT_POINTS = 20000
+# The archive overview reads the finest overview level (or the samples) with at most this many points in view
+OVERVIEW_MAX_POINTS = 4000
+
 start_of_today = dt.datetime.now().date()
 end_of_today = start_of_today + dt.timedelta(days=1)
 four_weeks_ago = end_of_today - dt.timedelta(days=28)
@@ -38,6 +48,16 @@ widgets = {
     ),
     "file-dropper": CustomisedFileDropper(multiple=False),
     "evaluate-button": pn.widgets.Button(name="Click to evaluate", button_type="primary"),
+    "cancel-button": pn.widgets.Button(name="Cancel", button_type="danger", disabled=True),
+    "use-archive": pn.widgets.Checkbox(name="Use the processed FAST FAC files where available", value=True),
+    "confirm-long-range": pn.widgets.Checkbox(
+        name="I understand that this will take a long time to evaluate", visible=False
+    ),
+    # Display settings (applied to the cached results without re-evaluating)
+    "variable": pn.widgets.Select(name="Variable", options=["FAC"], value="FAC"),
+    "flags-F-max": pn.widgets.IntInput(name="Maximum Flags_F", value=1, start=0),
+    "flags-B-max": pn.widgets.IntInput(name="Maximum Flags_B", value=1, start=0),
+    "ylim": pn.widgets.EditableRangeSlider(name="y-axis limits", start=-100, end=100, value=(-30, 30), step=1),
 }
 
 
@@ -49,9 +69,25 @@ class FacDataExplorer:
         self.swarmpal_quicklook = pn.pane.Matplotlib()
         self.code_snippet = pn.pane.Markdown(styles={"font-size": "15px",})
         self.output_title = pn.pane.Markdown(styles={"font-size": "20px",})
-        self.data_view = pn.pane.HTML()
+        self.job_status = pn.pane.Markdown()
+        self.data_view = DataTreeTable()
+        self.cost_estimate = pn.pane.Markdown()
+        # Only built when its tab is opened
+        self.archive_overview = pn.param.ParamFunction(
+            pn.bind(self._archive_overview, self.widgets["spacecraft"]), lazy=True
+        )
+        self.data = None
+        self._evaluation = None
+        # The results of each chunk of the evaluation in progress (joined once it ends)
+        self._chunks = []
+        # The segments of the results read from the processor outputs: (start, end, file name)
+        self._archived = []
+        # Number of samples expected in the interactive plot, and how many are binned into each min/max pair
+        self._plot_samples = 1
+        self._plot_stride = 1
         self.output_pane = pn.Column(
             self.output_title,
+            self.job_status,
             pn.layout.Divider(),
             self.cdf_download,
             pn.layout.Divider(),
@@ -60,10 +96,17 @@ class FacDataExplorer:
                 ("Interactive view", self.interactive_output),
                 ("Data view", self.data_view),
                 ("SwarmPAL Python Code", self.code_snippet),
+                ("Processed archive", self.archive_overview),
+                dynamic=True,
             ),
         )
         self.widgets["evaluate-button"].on_click(self.update_data)
+        self.widgets["cancel-button"].on_click(self.cancel_evaluation)
+        self.widgets["start-end"].param.watch(self.update_cost_estimate, "value")
         self.widgets["file-dropper"].param.watch(self.update_data_local, "value")
+        for name in ("variable", "flags-F-max", "flags-B-max", "ylim"):
+            self.widgets[name].param.watch(self.update_display, "value")
+        self.update_cost_estimate(None)
         # self.update_data(None)
 
     @property
@@ -77,26 +120,126 @@ class FacDataExplorer:
             pn.layout.Divider(),
             pn.pane.Markdown("Select processing chain: (FAST only available for Swarm)"),
             self.widgets["grade"],
+            self.widgets["use-archive"],
             pn.layout.Divider(),
-            self.widgets["evaluate-button"],
+            self.cost_estimate,
+            self.widgets["confirm-long-range"],
+            pn.Row(self.widgets["evaluate-button"], self.widgets["cancel-button"]),
         )
         local_file_widgets = pn.Column(
             pn.pane.Markdown("Upload CDF file:"),
             self.widgets["file-dropper"],
             pn.layout.Divider(),
         )
+        display_widgets = pn.Column(
+            pn.pane.Markdown("Display settings:"),
+            self.widgets["variable"],
+            self.widgets["flags-F-max"],
+            self.widgets["flags-B-max"],
+            self.widgets["ylim"],
+        )
         return pn.Column(
             pn.Tabs(
                 ("VirES (remote)", vires_widgets),
                 ("CDF File", local_file_widgets),
             ),
+            pn.layout.Divider(),
+            display_widgets,
+        )
+
+    @property
+    def time_range(self):
+        """The selected time range, as datetimes (the picker gives dates until the range is edited)"""
+        return tuple(
+            t if isinstance(t, dt.datetime) else dt.datetime.combine(t, dt.time())
+            for t in self.widgets["start-end"].value
         )
 
     @property
     def time_start_end_str(self):
-        t_s, t_e = self.widgets["start-end"].value
+        t_s, t_e = self.time_range
         return f'{t_s.strftime("%Y%m%dT%H%M%S")}_{t_e.strftime("%Y%m%dT%H%M%S")}'
 
+    @property
+    def data(self):
+        """The cached results of the last evaluation"""
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        # Identifies the current results (and their filtered versions) to the CDF export cache
+        self._result_token = CDF_EXPORTS.new_token()
+        # Masks and filtered results are cached per flag threshold for the current results only
+        self._mask_cache = {}
+        self._display_data_cache = {}
+
+    @property
+    def fac(self):
+        return self.data["PAL_FAC_single_sat"].to_dataset()
+
+    def valid_mask(self, fac, cache=None):
+        """Boolean mask of the samples passing the flag thresholds (None if there are no flags)
+
+        Masks for each flag and threshold are stored in cache (optional) to be reused.
+        """
+        if "Flags_F" not in fac.data_vars:
+            return None
+        cache = {} if cache is None else cache
+        masks = []
+        for flag, threshold in (
+            ("Flags_F", self.widgets["flags-F-max"].value),
+            ("Flags_B", self.widgets["flags-B-max"].value),
+        ):
+            if (flag, threshold) not in cache:
+                cache[(flag, threshold)] = (fac[flag] <= threshold).values
+            masks.append(cache[(flag, threshold)])
+        return masks[0] & masks[1]
+
+    @property
+    def display_fac(self):
+        """The cached FAC results, filtered with the current flag thresholds"""
+        fac = self.fac
+        mask = self.valid_mask(fac, cache=self._mask_cache)
+        return fac if mask is None else fac.isel(Timestamp=mask)
+
+    def filtered(self, data, cache=None):
+        """A copy of some results with the FAC filtered with the current flag thresholds"""
+        fac = data["PAL_FAC_single_sat"].to_dataset()
+        mask = self.valid_mask(fac, cache=cache)
+        data = data.copy()
+        data["PAL_FAC_single_sat"] = fac if mask is None else fac.isel(Timestamp=mask)
+        return data
+
+    @property
+    def display_token(self):
+        """Token of the filtered results for the current flag thresholds (see CdfExportService)"""
+        return f'{self._result_token}-{self.widgets["flags-F-max"].value}-{self.widgets["flags-B-max"].value}'
+
+    @property
+    def display_data(self):
+        """The cached results with the FAC filtered with the current flag thresholds"""
+        # Kept per threshold so that the same object is reused
+        key = (self.widgets["flags-F-max"].value, self.widgets["flags-B-max"].value)
+        if key not in self._display_data_cache:
+            self._display_data_cache[key] = self.filtered(self.data, cache=self._mask_cache)
+        return self._display_data_cache[key]
+
+    @property
+    def n_days(self):
+        t_s, t_e = self.time_range
+        return (t_e - t_s) / dt.timedelta(days=1)
+
+    @property
+    def time_chunks(self):
+        """Split the selected time range into chunks of CHUNK_DURATION"""
+        t_s, t_e = self.time_range
+        chunks = []
+        while t_s < t_e:
+            chunks.append((t_s, min(t_s + CHUNK_DURATION, t_e)))
+            t_s = t_s + CHUNK_DURATION
+        return chunks
+
     @property
     def spacecraft(self):
         return self.widgets["spacecraft"].value
@@ -148,8 +291,8 @@ class FacDataExplorer:
                 collection=collection,
                 measurements=measurements,
                 models=["CHAOS"],
-                start_time=self.widgets["start-end"].value[0].isoformat(),
-                end_time=self.widgets["start-end"].value[1].isoformat(),
+                start_time=self.time_range[0].isoformat(),
+                end_time=self.time_range[1].isoformat(),
                 server_url="https://vires.services/ows",
                 options=dict(asynchronous=False, show_progress=False),
             )
@@ -185,52 +328,153 @@ class FacDataExplorer:
                 time_jump_limit=1,
             )
 
-    def update_data(self, event):
-        """Fetch and process the data"""
+    def update_cost_estimate(self, event):
+        """Estimate the cost of evaluating the selected range, and require confirmation of long ranges"""
+        n_days = self.n_days
+        estimate = f"Estimated size: {n_days:.3g} days, ~{n_days * SAMPLES_PER_DAY:,.0f} samples ({math.ceil(n_days)} chunks)"
+        if n_days > MAX_DAYS:
+            estimate += f"\n\n**Ranges longer than {MAX_DAYS:g} days are not allowed. Please select a shorter range.**"
+        self.cost_estimate.object = estimate
+        self.widgets["confirm-long-range"].visible = CONFIRM_ABOVE_DAYS < n_days <= MAX_DAYS
+        self.widgets["confirm-long-range"].value = False
+        # (the buttons are reset when a running evaluation ends)
+        if self._evaluation is None:
+            self.widgets["evaluate-button"].disabled = n_days > MAX_DAYS
+
+    def cancel_evaluation(self, event):
+        """Stop the running evaluation (the chunks already evaluated are kept)"""
+        if self._evaluation is not None:
+            self._evaluation.cancel()
+
+    async def update_data(self, event):
+        """Fetch and process the data, one chunk at a time"""
+        if self.n_days > MAX_DAYS:
+            return
+        if self.n_days > CONFIRM_ABOVE_DAYS and not self.widgets["confirm-long-range"].value:
+            self.job_status.object = "**Please confirm that you want to evaluate such a long range.**"
+            return
         self.set_mode("vires")
         self.set_data_params(mode="vires")
-        self.data = create_paldata(
-            PalDataItem.from_vires(**self.data_params)
-        )
         self.set_process_params(mode="vires")
-        process = FAC_single_sat(
-            config=self.process_params
-        )
-        self.data = process(self.data)
+        # The settings are read once here: changing the widgets while evaluating does not affect the evaluation
+        spacecraft, grade = self.spacecraft, self.grade
+        use_archive = self.widgets["use-archive"].value and grade == "FAST" and "Swarm" in spacecraft
+        archive = get_fac_archive(spacecraft[-1]) if use_archive else None
+        filename = f"SwarmPAL_FAC_{spacecraft}_{grade}_{self.time_start_end_str}.cdf"
         title = f"""
-        {self.widgets["spacecraft"].value} {self.widgets["grade"].value}: FAC single-satellite method
+        {spacecraft} {grade}: FAC single-satellite method
         
-        {self.widgets["start-end"].value[0]} to {self.widgets["start-end"].value[1]}
+        {self.time_range[0]} to {self.time_range[1]}
         """
+        self.data = None
+        self._chunks = []
+        self.cdf_download.callback = None
+        self._new_interactive_output(length=math.ceil(self.n_days * SAMPLES_PER_DAY))
+        self.widgets["evaluate-button"].disabled = True
+        self.widgets["cancel-button"].disabled = False
+        # An upload would replace the outputs that the remaining chunks are appended to
+        self.widgets["file-dropper"].disabled = True
+        self._evaluation = asyncio.ensure_future(self._evaluate_chunks(
+            title, self.time_chunks, self.data_params, self.process_params, archive
+        ))
+        try:
+            await self._evaluation
+        except asyncio.CancelledError:
+            self.job_status.object = ""
+            title += "\n\n*Cancelled: showing the data evaluated so far*"
+        finally:
+            self._evaluation = None
+            # Joined once at the end (joining each chunk as it arrives would copy all the results each time)
+            self.data = concat_datatrees(self._chunks) if self._chunks else None
+            self._chunks = []
+            self.widgets["evaluate-button"].disabled = self.n_days > MAX_DAYS
+            self.widgets["cancel-button"].disabled = True
+            self.widgets["file-dropper"].disabled = False
+        if self._archived:
+            title += f"\n\n*{len(self._archived)} segments read from the processed FAST FAC files*"
+        if self.data is None:
+            self.output_title.object = title
+            return
         self.update_output_pane(title)
-        self.update_output_file(f'SwarmPAL_FAC_{self.spacecraft}_{self.grade}_{self.time_start_end_str}.cdf')
-    
-    def update_data_local(self, event):
+        self.update_output_file(filename)
+
+    @staticmethod
+    def _segments(t_s, t_e, archive=None):
+        """Split a time range into segments read from the processor outputs (with their file) or evaluated live (None)"""
+        if archive is None:
+            return [(t_s, t_e, None)]
+        return archive.split(t_s, t_e)
+
+    @staticmethod
+    def _archived_tree(fac, process_params):
+        """A DataTree like those evaluated live, from FAC read from the processor outputs
+
+        The processor evaluates with the same parameters as the dashboard, so these are
+        recorded as the FAC_single_sat configuration (read by the quicklook).
+        """
+        leaf = fac.copy()
+        leaf.attrs["PAL_meta"] = json.dumps({"FAC_single_sat": process_params})
+        data = xr.DataTree.from_dict({"PAL_FAC_single_sat": leaf})
+        data.attrs["PAL_meta"] = json.dumps({"output_datasets": ["PAL_FAC_single_sat"]})
+        return data
+
+    async def _evaluate_chunks(self, title, chunks, data_params, process_params, archive=None):
+        """Evaluate each time chunk in turn, appending it to the outputs as it completes
+
+        Segments already processed by the processor are read from its outputs (archive) instead.
+        """
+        self._archived = []
+        for i, (t_s, t_e) in enumerate(chunks):
+            for s_s, s_e, path in self._segments(t_s, t_e, archive):
+                if path is not None:
+                    fac = await asyncio.to_thread(archive.read_file, path, s_s, s_e)
+                    self._archived.append((s_s, s_e, path.name))
+                    data = self._archived_tree(fac, process_params)
+                else:
+                    segment_params = dict(data_params, start_time=s_s.isoformat(), end_time=s_e.isoformat())
+                    data = await run_job(
+                        "fac-from-vires", segment_params, process_params, status_pane=self.job_status
+                    )
+                    if data is None:
+                        # Refused or failed (the reason is shown in job_status)
+                        return
+                    self.job_status.object = ""
+                    fac = data["PAL_FAC_single_sat"].to_dataset()
+                self._update_variable_options(fac)
+                self._chunks.append(data)
+                self._append_to_interactive_output(fac, self.valid_mask(fac))
+                # Only the newest results are shown in the table until the evaluation ends
+                self.data_view.set_data(self.filtered(data), leaf="PAL_FAC_single_sat")
+            self.output_title.object = title + f"\n\n*Evaluated {i + 1} of {len(chunks)} chunks...*"
+
+    async def update_data_local(self, event):
         """Fetch and process the data"""
+        if self._evaluation is not None:
+            return
         self.set_mode("local")
+        self._archived = []
         # Identify file name and set product name from that
         filename = self.widgets["file-dropper"].file_in_mem.name
         self.set_data_params(mode="local", filename=filename)
         product_name_full = Path(filename).stem
         # Truncate to remove data and version
         product_name = re.sub(r"_\d{8}T\d{6}.*$", "", product_name_full)
-        # Load the CDF file into a SwarmPAL DataTree
-        self.data = create_paldata(
-            **{product_name: PalDataItem.from_file(self.widgets["file-dropper"].temp_file.name, filetype="cdf")}
-        )
-        # Evaluate the field model locally
-        process_local_model = LocalForwardMagneticModel()
-        process_local_model.set_config(
-            dataset=product_name,
-            model_descriptor="CHAOS-Core",
-        )
-        self.data = process_local_model(self.data)
-        # Apply the FAC single-satellite process
+        # Load the CDF file, evaluate the field model locally and apply the FAC single-satellite process
         self.set_process_params(mode="local", dataset=product_name)
-        process = FAC_single_sat(
-            config=self.process_params
+        data = await run_job(
+            "fac-from-file",
+            self.widgets["file-dropper"].temp_file.name,
+            product_name,
+            self.process_params,
+            status_pane=self.job_status,
         )
-        self.data = process(self.data)
+        if data is None:
+            return
+        self.job_status.object = ""
+        self._update_variable_options(data["PAL_FAC_single_sat"].to_dataset())
+        self.data = data
+        self._new_interactive_output(length=self.fac.sizes["Timestamp"])
+        self._append_to_interactive_output(self.display_fac)
         title = f"""
         {self.widgets["file-dropper"].file_in_mem.name}
 
@@ -239,19 +483,103 @@ class FacDataExplorer:
         self.update_output_pane(title)
         self.update_output_file(f'SwarmPAL_FAC_{product_name_full}.cdf')
 
+    def _update_variable_options(self, fac):
+        """Offer the variables of the results which can be plotted against time"""
+        options = [
+            name for name, variable in fac.data_vars.items()
+            if variable.dims == ("Timestamp",) and not name.startswith("Flags")
+        ]
+        if options and options != self.widgets["variable"].options:
+            self.widgets["variable"].options = options
+            if self.widgets["variable"].value not in options:
+                self.widgets["variable"].value = "FAC" if "FAC" in options else options[0]
+
+    def _new_interactive_output(self, length):
+        """Start a new interactive plot, to which data is appended with _append_to_interactive_output"""
+        import holoviews as hv
+        import hvplot.xarray  # noqa: F401 (loads the bokeh plotting extension)
+        from holoviews.streams import Buffer
+
+        variable = self.widgets["variable"].value
+        empty = pd.DataFrame({"Timestamp": pd.Series(dtype="datetime64[ns]"), variable: pd.Series(dtype=float)})
+        self._plot_samples = max(length, 1)
+        self._plot_stride = max(math.ceil(2 * self._plot_samples / MAX_PLOT_POINTS), 1)
+        # (each piece sent may add one partly filled bin)
+        self._plot_buffer = Buffer(empty, length=2 * MAX_PLOT_POINTS, index=False, following=False)
+        self.interactive_output.object = hv.DynamicMap(
+            partial(hv.Curve, kdims=["Timestamp"], vdims=[variable]), streams=[self._plot_buffer]
+        ).opts(ylim=tuple(self.widgets["ylim"].value), responsive=True, min_height=400)
+
+    def _append_to_interactive_output(self, fac, mask=None):
+        """Send the samples of a dataset (those selected by mask, if given) to the interactive plot"""
+        if mask is not None:
+            fac = fac.isel(Timestamp=mask)
+        variable = self.widgets["variable"].value
+        samples = fac[variable]
+        if self._plot_stride > 1 and samples.sizes["Timestamp"]:
+            samples = samples.isel(Timestamp=self._min_max_indices(samples.values, self._plot_stride))
+        self._plot_buffer.send(samples.to_dataframe()[[variable]].reset_index())
+
+    @staticmethod
+    def _min_max_indices(values, stride):
+        """Indices of the minimum and maximum of each bin of stride samples (in time order)"""
+        n_bins = math.ceil(len(values) / stride)
+        padded = np.full(n_bins * stride, np.nan)
+        padded[:len(values)] = values
+        binned = padded.reshape(n_bins, stride)
+        finite = np.isfinite(binned)
+        offsets = np.arange(n_bins) * stride
+        lowest = np.where(finite, binned, np.inf).argmin(axis=1) + offsets
+        highest = np.where(finite, binned, -np.inf).argmax(axis=1) + offsets
+        return np.unique(np.minimum(np.concatenate([lowest, highest]), len(values) - 1))
+
+    def update_display(self, event):
+        """Re-render the outputs from the cached results with the current display settings"""
+        self._new_interactive_output(length=self._plot_samples)
+        if self.data is None:
+            # While evaluating, show the chunks evaluated so far again
+            for data in self._chunks:
+                fac = data["PAL_FAC_single_sat"].to_dataset()
+                self._append_to_interactive_output(fac, self.valid_mask(fac))
+            if self._chunks:
+                self.data_view.set_data(self.filtered(self._chunks[-1]), leaf="PAL_FAC_single_sat")
+            return
+        self._append_to_interactive_output(self.display_fac)
+        self.data_view.set_data(self.display_data, leaf="PAL_FAC_single_sat")
+
+    def _archive_overview(self, spacecraft):
+        """Plot of all the processed FAST FAC files, read at the resolution needed for the range in view"""
+        if "Swarm" not in spacecraft:
+            return pn.pane.Markdown("Processed FAST FAC files are only available for Swarm.")
+        import holoviews as hv
+        import hvplot.xarray  # noqa: F401 (loads the bokeh plotting extension)
+        from holoviews.streams import RangeX
+
+        archive = get_fac_archive(spacecraft[-1])
+        extent = archive.overview_extent("FAC")
+        if extent is None:
+            return pn.pane.Markdown("No overview of the processed FAST FAC files was found.")
+
+        def plot(x_range):
+            t_s, t_e = x_range if x_range else extent
+            level, records = archive.read_overview("FAC", t_s, t_e, max_points=OVERVIEW_MAX_POINTS)
+            resolution = "samples" if level == "raw" else f"{level} min/max/mean"
+            return (
+                hv.Area((records["time"], records["min"], records["max"]), "Timestamp", ["FAC min", "FAC max"]).opts(alpha=0.3)
+                * hv.Curve((records["time"], records["mean"]), "Timestamp", "FAC")
+            ).opts(title=f"{spacecraft} FAST FAC ({resolution})", responsive=True, min_height=400)
+
+        return pn.Column(
+            pn.pane.Markdown(
+                f"FAC of the processed FAST FAC files, without the samples with Flags_F or Flags_B above {OVERVIEW_FLAGS_MAX}."
+                " These thresholds are fixed when the overview is written: the display settings do not apply here."
+            ),
+            pn.pane.HoloViews(hv.DynamicMap(plot, streams=[RangeX()])),
+        )
+
     def update_output_pane(self, title="SwarmPAL FAC"):
         """Update all output panes"""
         self.output_title.object = title
-        # Interactive HoloViews plot
-        if "Flags_F" in self.data["PAL_FAC_single_sat"].data_vars:
-            mask_valid_F = self.data["PAL_FAC_single_sat"]["Flags_F"] <= 1
-            mask_valid_B = self.data["PAL_FAC_single_sat"]["Flags_B"] <= 1
-            mask_valid = mask_valid_F & mask_valid_B
-            masked_data = self.data["PAL_FAC_single_sat"].to_dataset().where(mask_valid, drop=True)
-            hvplot_obj = masked_data.hvplot(x="Timestamp", y="FAC", ylim=(-30, 30))
-        else:
-            hvplot_obj = self.data["PAL_FAC_single_sat"].to_dataset().hvplot(x="Timestamp", y="FAC", ylim=(-30, 30))
-        self.interactive_output.object = hvplot_obj
         # SwarmPAL quicklook
         try:
             fig, _ = self.data.swarmpal_fac.quicklook()
@@ -262,31 +590,22 @@ class FacDataExplorer:
         # Code snippet
         self.code_snippet.object = f"```python\n{self.get_code()}\n```"
         # Data view
-        self.data_view.object = self.data._repr_html_()
+        self.data_view.set_data(self.display_data, leaf="PAL_FAC_single_sat")
 
     @staticmethod
     def _empty_matplotlib_figure():
+        import matplotlib.pyplot as plt
+
         fig, ax = plt.subplots()
         ax.set_axis_off()
         ax.text(0.5, 0.5, "No data available / error in figure creation", ha="center", va="center", fontsize=20)
         return fig
 
-    def get_cdf_file(self):
-        # work around the weirdness of cdflib xarray tools by writing to another file first then moving to a temporary file
-        deleteme ="/tmp/tmp" + "".join(random.choice(string.ascii_letters + string.digits) for _ in range(10)) + ".cdf"
-        self.data.swarmpal.to_cdf(deleteme, leaf="PAL_FAC_single_sat")
-        # Create the tempfile as a an object property so it doesn't go out of scope and get deleted
-        # It will automatically be replaced (and old file removed) each time this is run
-        self.tempfile_cdf = NamedTemporaryFile()
-        with open(deleteme, "rb") as src_file:
-            shutil.copyfileobj(src_file, self.tempfile_cdf)
-            self.tempfile_cdf.seek(0)
-        os.remove(deleteme)
-        return self.tempfile_cdf
-
     def update_output_file(self, filename="SwarmPAL_FAC.cdf"):
-        self.cdf_download.file = self.get_cdf_file().name
-        self.cdf_download.filename = filename
+        # Exported when requested, so that it follows the display settings at that time
+        CDF_EXPORTS.attach(
+            self.cdf_download, lambda: self.display_token, lambda: self.display_data, "PAL_FAC_single_sat", filename
+        )
     
     def get_code(self):
         """
@@ -309,6 +628,9 @@ class FacDataExplorer:
                 "model_varname": process_params["model_varname"],
                 "measurement_varname": process_params["measurement_varname"],
                 "time_jump_limit": process_params["time_jump_limit"],
+                "archived": [
+                    (s_s.isoformat(), s_e.isoformat(), filename) for s_s, s_e, filename in self._archived
+                ],
             }
         elif self.mode == "local":
             context = {
@@ -1,28 +1,14 @@
 import datetime as dt
-import os
 from pathlib import Path
-import random
 import re
-import shutil
-import string
-from tempfile import NamedTemporaryFile
 
-import cartopy.crs as ccrs
-import hvplot.xarray
-import matplotlib.pyplot as plt
 import panel as pn
-import xarray as xr
 
-from swarmpal_mma.pal_processes import MMA_SHA_2E
-from swarmpal_mma.Plotting.map_plot import map_surface_rtp
-from swarmpal.experimental import LocalForwardMagneticModel
-from swarmpal.io import PalDataItem, create_paldata
 from swarmpal.utils.configs import SPACECRAFT_TO_MAGLR_DATASET
 
-from common import HEADER, JINJA2_ENVIRONMENT, CustomisedFileDropper
+from common import CDF_EXPORTS, HEADER, JINJA2_ENVIRONMENT, CustomisedFileDropper, DataTreeTable, run_job
 
 pn.extension('filedropper')
-xr.set_options(display_expand_groups=True, display_expand_attrs=True, display_expand_data_vars=True, display_expand_coords=True)
 
 MMA_2E_CODE_TEMPLATE = "mma-2e.jinja2"
 
@@ -59,13 +45,13 @@ class MmaDataExplorer:
         self.interactive_output = pn.pane.HoloViews()
         self.swarmpal_quicklook = pn.pane.Matplotlib()
         self.code_snippet = pn.pane.Markdown(styles={"font-size": "15px",})
-        self.data_view = pn.pane.HTML()
+        self.data_view = DataTreeTable()
         self.output_title = pn.pane.Markdown()
         self.output_pane = pn.Column(
             self.output_title,
             pn.layout.Divider(),
-            # self.cdf_download,
-            # pn.layout.Divider(),
+            self.cdf_download,
+            pn.layout.Divider(),
             pn.Tabs(
                 ("Data view", self.data_view),
                 ("SwarmPAL quicklook", self.swarmpal_quicklook),
@@ -124,54 +110,29 @@ class MmaDataExplorer:
             )
         return data_config
     
-    def load_local_data(self) -> tuple[str, PalDataItem] | None:
-        """Load local data from a file"""
+    def get_local_file(self) -> tuple[str, str] | None:
+        """Identify the uploaded file as (product_name, filename on disk)"""
         if self.widgets["file-dropper"].value:
             # Identify file name and set product name from that
             filename = self.widgets["file-dropper"].file_in_mem.name
             product_name_full = Path(filename).stem
             # Truncate to remove data and version
             product_name = re.sub(r"_\d{8}T\d{6}.*$", "", product_name_full)
-            # Load the file
-            pdi = PalDataItem.from_file(self.widgets["file-dropper"].temp_file.name, filetype="cdf")
-            return product_name, pdi
+            return product_name, self.widgets["file-dropper"].temp_file.name
         else:
             return None
 
-    def fetch_data(self):
-        data = create_paldata(
-            **{
-                label: PalDataItem.from_vires(**data_params)
-                for label, data_params in self.get_data_config().items()
-            }
-        )
-        if self.widgets["file-dropper"].value:
-            # If a file is uploaded, read it and add it to the data
-            product_name, pdi = self.load_local_data()
-            data[product_name] = pdi.xarray
-            # (HACK) Subset the data to match the PT25S data cadence
-            data[product_name] = data[product_name].sel(Timestamp=data[product_name].ds["Timestamp"][::25])
-            # Evaluate the CHAOS model locally
-            process_local_model = LocalForwardMagneticModel()
-            process_local_model.set_config(
-                dataset=product_name,
-                model_descriptor="CHAOS-Core",
-            )
-            process_local_model(data)
-        return data
-
-    @staticmethod
-    def _run_mma_2e_code(data):
-        mma_process = MMA_SHA_2E()
-        mma_process.set_config(
-            measurement_varname="B_NEC",
-            model_varname="B_NEC_CHAOS-Core",
+    async def fetch_data(self):
+        return await run_job(
+            "mma-inputs", self.get_data_config(), self.get_local_file(), status_pane=self.output_title
         )
-        data = mma_process(data)
-        return data
 
     @staticmethod
     def _quicklook(data):
+        import cartopy.crs as ccrs
+        import matplotlib.pyplot as plt
+        from swarmpal_mma.Plotting.map_plot import map_surface_rtp
+
         ds = data["MMA_SHA_2E"].ds
         fig, axes = plt.subplots(nrows=2, ncols=1, figsize=(8, 7))
         axes[0].plot(ds["time"], ds["qs"][:, 0], label="q^1_0")
@@ -185,24 +146,28 @@ class MmaDataExplorer:
         # axes = None
         return fig, axes
 
-    def update_input_data(self, event):
-        self.data_view.object = ""
+    async def update_input_data(self, event):
+        self.data_view.clear()
+        self.cdf_download.callback = None
         self.swarmpal_quicklook.object = self._pending_matplotlib_figure()
-        self.data = self.fetch_data()
-        # self.data_view.object = self.data  # when html repr is fixed
-        raw_string = self.data.__str__()
-        html_string = raw_string.replace("\n", "<br>")
-        self.data_view.object = f"<pre>{html_string}</pre>"
+        data = await self.fetch_data()
+        if data is None:
+            return
+        self.data = data
+        self.output_title.object = ""
+        self.data_view.set_data(self.data)
         self.code_snippet.object = f"```python\n{self.get_code()}\n```"
 
-    def update_analysis(self, event):
-        self.data = self._run_mma_2e_code(self.data)
-        # self.data_view.object = self.data  # when html repr is fixed
-        raw_string = self.data.__str__()
-        html_string = raw_string.replace("\n", "<br>")
-        self.data_view.object = f"<pre>{html_string}</pre>"
+    async def update_analysis(self, event):
+        data = await run_job("mma-2e", self.data, status_pane=self.output_title)
+        if data is None:
+            return
+        self.data = data
+        # Identifies these results to the CDF export cache
+        self._result_token = CDF_EXPORTS.new_token()
+        self.data_view.set_data(self.data, leaf="MMA_SHA_2E")
         self._update_output_pane()
-        # self._update_cdf_file()
+        self._update_cdf_file()
 
     def _update_output_pane(self):
         # title = f"## {self.widgets['spacecraft'].value} \n{self.widgets['start-end'].value[0]} to {self.widgets['start-end'].value[1]}"
@@ -226,6 +191,8 @@ class MmaDataExplorer:
 
     @staticmethod
     def _empty_matplotlib_figure():
+        import matplotlib.pyplot as plt
+
         fig, ax = plt.subplots()
         ax.set_axis_off()
         ax.text(
@@ -240,34 +207,20 @@ class MmaDataExplorer:
 
     @staticmethod
     def _pending_matplotlib_figure():
+        import matplotlib.pyplot as plt
+
         fig, ax = plt.subplots()
         ax.set_axis_off()
         ax.text(0.5, 0.5, "Analysis not yet run", ha="center", va="center", fontsize=20)
         return fig
 
-    def get_cdf_file(self):
-        # work around the weirdness of cdflib xarray tools by writing to another file first then moving to a temporary file
-        deleteme = (
-            "/tmp/tmp"
-            + "".join(
-                random.choice(string.ascii_letters + string.digits) for _ in range(10)
-            )
-            + ".cdf"
-        )
-        self.data.swarmpal.to_cdf(deleteme, leaf="PAL_FAC_single_sat")
-        # Create the tempfile as a an object property so it doesn't go out of scope and get deleted
-        # It will automatically be replaced (and old file removed) each time this is run
-        self.tempfile_cdf = NamedTemporaryFile()
-        with open(deleteme, "rb") as src_file:
-            shutil.copyfileobj(src_file, self.tempfile_cdf)
-            self.tempfile_cdf.seek(0)
-        os.remove(deleteme)
-        return self.tempfile_cdf
-
     def _update_cdf_file(self):
-        self.cdf_download.file = self.get_cdf_file().name
-        self.cdf_download.filename = (
-            f"SwarmPAL_FAC_{self.spacecraft}_{self.grade}_{self.time_start_end_str}.cdf"
+        CDF_EXPORTS.attach(
+            self.cdf_download,
+            lambda: self._result_token,
+            lambda: self.data,
+            "MMA_SHA_2E",
+            f"SwarmPAL_MMA_SHA_2E_{self.time_start_end_str}.cdf",
         )
 
     def get_code(self):
@@ -0,0 +1,210 @@
+"""
+Access to the products already generated by the processor (tasks/outputs)
+
+An ArchiveIndex maps the time ranges covered by the product files in a directory (from
+their names) so that a time range can be split into the parts which are covered by the
+archive and the gaps which are not. Only the records of each file which overlap the
+requested range are read.
+
+For browsing long periods, the processor also keeps overview levels of the products
+(min/max/mean per minute, hour and day, see tasks/overview.py), read here with
+numpy.memmap so that only the bins within the requested range are touched. Their format
+is defined once, in tasks/overview.py, and imported from there.
+
+The location of the outputs is set with SWARMPAL_ARCHIVE_DIR (default: tasks/outputs).
+"""
+
+import bisect
+import datetime as dt
+import os
+from pathlib import Path
+import re
+import sys
+import threading
+
+import numpy as np
+import xarray as xr
+
+TASKS_DIR = Path(__file__).parent.parent / "tasks"
+ARCHIVE_DIR = Path(os.environ.get("SWARMPAL_ARCHIVE_DIR", TASKS_DIR / "outputs"))
+
+# The format of the overview levels (finest first), as written by the processor
+sys.path.append(str(TASKS_DIR))
+from overview import FLAGS_MAX as OVERVIEW_FLAGS_MAX, OVERVIEW_DIRECTORY, OVERVIEW_LEVELS, OVERVIEW_RECORD  # noqa: E402
+
+
+class ArchiveIndex:
+    """Time-range index over the product files in one directory"""
+
+    def __init__(self, directory, file_prefix):
+        self.directory = Path(directory)
+        self.file_prefix = file_prefix
+        self.product_naming = rf"{file_prefix}_(\d{{8}}T\d{{6}})_(\d{{8}}T\d{{6}})_.{{4}}\.(cdf|CDF)$"
+        self._lock = threading.Lock()
+        self._directory_mtime = None
+        # Sorted by start time: start times, (closed-open) end times and paths
+        self._starts = []
+        self._ends = []
+        self._paths = []
+
+    def refresh(self):
+        """Rescan the directory if its contents have changed"""
+        with self._lock:
+            try:
+                mtime = self.directory.stat().st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            if mtime == self._directory_mtime:
+                return
+            entries = []
+            if mtime is not None:
+                for filename in os.listdir(self.directory):
+                    match = re.match(self.product_naming, filename)
+                    if match:
+                        t_start = dt.datetime.strptime(match.group(1), "%Y%m%dT%H%M%S")
+                        # Convert naming scheme closed bound [a,b] to closed-open [a,b)
+                        t_end = dt.datetime.strptime(match.group(2), "%Y%m%dT%H%M%S") + dt.timedelta(seconds=1)
+                        entries.append((t_start, t_end, self.directory / filename))
+            entries.sort()
+            self._starts = [entry[0] for entry in entries]
+            self._ends = [entry[1] for entry in entries]
+            self._paths = [entry[2] for entry in entries]
+            self._directory_mtime = mtime
+
+    def overlapping(self, t_start, t_end):
+        """Files overlapping [t_start, t_end), as a list of (file start, file end, path)"""
+        self.refresh()
+        # Files are contiguous and do not overlap each other, so only the one before the
+        # first file starting after t_start can also overlap
+        first = max(bisect.bisect_right(self._starts, t_start) - 1, 0)
+        last = bisect.bisect_left(self._starts, t_end)
+        return [
+            (self._starts[i], self._ends[i], self._paths[i])
+            for i in range(first, last)
+            if self._ends[i] > t_start
+        ]
+
+    def split(self, t_start, t_end):
+        """Split [t_start, t_end) into consecutive segments (segment start, segment end, path or None for a gap)"""
+        segments = []
+        t = t_start
+        for file_start, file_end, path in self.overlapping(t_start, t_end):
+            if file_start > t:
+                segments.append((t, file_start, None))
+                t = file_start
+            segment_end = min(file_end, t_end)
+            if segment_end > t:
+                segments.append((t, segment_end, path))
+                t = segment_end
+        if t < t_end:
+            segments.append((t, t_end, None))
+        return segments
+
+    @staticmethod
+    def read_file(path, t_start, t_end):
+        """Read the records of a product file within [t_start, t_end) as a Dataset (with the global attributes of the file)"""
+        import cdflib
+
+        # (the file is closed when the CDF object is deleted)
+        cdf = cdflib.CDF(path)
+        times = np.asarray(cdflib.cdfepoch.to_datetime(cdf.varget("Timestamp")), dtype="datetime64[ns]")
+        first, stop = np.searchsorted(times, [np.datetime64(t_start, "ns"), np.datetime64(t_end, "ns")])
+        data_vars = {}
+        for name in cdf.cdf_info().zVariables:
+            info = cdf.varinq(name)
+            if name == "Timestamp":
+                continue
+            if info.Rec_Vary:
+                if stop > first:
+                    values = cdf.varget(name, startrec=int(first), endrec=int(stop) - 1)
+                else:
+                    values = np.empty((0,) + tuple(info.Dim_Sizes))
+            elif info.Dim_Sizes and info.Dim_Sizes[0] == len(times):
+                # Time series written as a single record (the whole variable must be read)
+                values = cdf.varget(name)[first:stop]
+            else:
+                continue
+            dims = ("Timestamp",) + tuple(f"{name}_dim{i}" for i in range(1, np.ndim(values)))
+            data_vars[name] = (dims, values, cdf.varattsget(name))
+        # Global attributes hold one entry each as written by the processor (e.g. PAL_meta)
+        attrs = {
+            name: entries[0] if isinstance(entries, list) and len(entries) == 1 else entries
+            for name, entries in cdf.globalattsget().items()
+        }
+        return xr.Dataset(data_vars, coords={"Timestamp": times[first:stop]}, attrs=attrs)
+
+    def read(self, t_start, t_end):
+        """Read the archived records within [t_start, t_end) (None if no records are archived)"""
+        parts = [
+            self.read_file(path, max(t_start, file_start), min(t_end, file_end))
+            for file_start, file_end, path in self.overlapping(t_start, t_end)
+        ]
+        if not parts:
+            return None
+        return xr.concat(parts, dim="Timestamp") if len(parts) > 1 else parts[0]
+
+    def overview(self, variable, level):
+        """The records of an overview level, mapped from its file (empty if there is none)"""
+        path = self.directory / OVERVIEW_DIRECTORY / f"{variable}_{level}.bin"
+        try:
+            # Ignore an incomplete record at the end (while the processor is appending)
+            n_records = path.stat().st_size // OVERVIEW_RECORD.itemsize
+        except FileNotFoundError:
+            n_records = 0
+        if not n_records:
+            return np.empty(0, OVERVIEW_RECORD)
+        return np.memmap(path, dtype=OVERVIEW_RECORD, mode="r", shape=(n_records,))
+
+    def overview_extent(self, variable):
+        """The time range covered by the overview of a variable (None if there is none)"""
+        records = self.overview(variable, "P1D")
+        if not len(records):
+            return None
+        return records["time"][0], records["time"][-1] + OVERVIEW_LEVELS["P1D"]
+
+    def read_overview(self, variable, t_start, t_end, max_points):
+        """Read [t_start, t_end) at the finest resolution giving no more than max_points
+
+        Returns (level, records): the level is "raw" when the samples themselves are few
+        enough, given as records with min = max = mean.
+        """
+        t_start, t_end = np.datetime64(t_start, "ns"), np.datetime64(t_end, "ns")
+        for level in OVERVIEW_LEVELS:
+            records = self.overview(variable, level)
+            # Bins from the one containing t_start
+            first = max(np.searchsorted(records["time"], t_start, side="right") - 1, 0)
+            stop = np.searchsorted(records["time"], t_end)
+            if stop - first > max_points and level != "P1D":
+                continue
+            if level == "PT1M" and stop > first and records["count"][first:stop].sum() <= max_points:
+                return "raw", self._raw_records(variable, t_start, t_end)
+            return level, np.array(records[first:stop])
+
+    def _raw_records(self, variable, t_start, t_end):
+        """The valid samples of a variable within [t_start, t_end), as overview records"""
+        data = self.read(t_start.astype("datetime64[us]").item(), t_end.astype("datetime64[us]").item())
+        if data is None:
+            return np.empty(0, OVERVIEW_RECORD)
+        values = data[variable].values.astype(float)
+        valid = np.isfinite(values)
+        for flag in ("Flags_F", "Flags_B"):
+            if flag in data:
+                valid &= data[flag].values <= OVERVIEW_FLAGS_MAX
+        records = np.empty(int(valid.sum()), OVERVIEW_RECORD)
+        records["time"] = data["Timestamp"].values[valid]
+        for field in ("min", "max", "mean"):
+            records[field] = values[valid]
+        records["count"] = 1
+        return records
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_fac_archive(spacecraft):
+    """The index of the FAST FAC products for a Swarm spacecraft (e.g. "A"), shared by all sessions"""
+    with _indexes_lock:
+        if spacecraft not in _indexes:
+            _indexes[spacecraft] = ArchiveIndex(ARCHIVE_DIR / f"Sat_{spacecraft}", f"SW_FAST_FAC{spacecraft}TMS_2F")
+        return _indexes[spacecraft]
@@ -1,10 +1,27 @@
-from collections import namedtuple
+import asyncio
+from collections import OrderedDict, namedtuple
+import importlib
+import io
+import math
+import os
 from pathlib import Path
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+import threading
+import uuid
 
 from jinja2 import Environment, FileSystemLoader
+import numpy as np
+import pandas as pd
 import panel as pn
+import xarray as xr
 
+from compute import CONNECTION_ERRORS, QueueFullError, get_compute_service, reset_compute_service, wait_for_job
+
+# NB: this module is imported (and so executed) once per server process, whereas
+# `panel serve` re-executes each dashboard script for every new session.
+# Process-wide state and slow imports therefore belong here, not in the dashboards.
+
+xr.set_options(display_expand_groups=True, display_expand_attrs=True, display_expand_data_vars=True, display_expand_coords=True)
 
 
 HEADER = pn.pane.Markdown(
@@ -31,6 +48,175 @@ HEADER = pn.pane.Markdown(
 CODE_TEMPLATE_DIR = Path(__file__).parent / Path("code_templates")
 JINJA2_ENVIRONMENT = Environment(loader=FileSystemLoader(CODE_TEMPLATE_DIR))
 
+# Modules that are only needed once a session draws a figure (the evaluations themselves
+# run in the compute service, see compute.py). The dashboards import them lazily, and
+# warm_up() imports them in the background so that the first session to need one
+# usually finds it already in sys.modules.
+HEAVY_MODULES = (
+    "matplotlib.pyplot",
+    "hvplot.xarray",
+    "cartopy.crs",
+    "swarmpal_mma.Plotting.map_plot",
+)
+
+_warm_up_lock = threading.Lock()
+_warm_up_thread = None
+
+
+def _import_heavy_modules():
+    for module_name in HEAVY_MODULES:
+        try:
+            importlib.import_module(module_name)
+        except ImportError:
+            # Left for the dashboard that needs it to raise when it is used
+            pass
+    for template_name in JINJA2_ENVIRONMENT.list_templates():
+        JINJA2_ENVIRONMENT.get_template(template_name)
+
+
+def warm_up():
+    """Initialise the shared heavy state in a background thread, once per server process"""
+    global _warm_up_thread
+    with _warm_up_lock:
+        if _warm_up_thread is None:
+            _warm_up_thread = threading.Thread(
+                target=_import_heavy_modules, name="swarmpal-warm-up", daemon=True
+            )
+            _warm_up_thread.start()
+    return _warm_up_thread
+
+
+warm_up()
+
+
+# Total size of the CDF exports kept in memory by each server process (see CdfExportService)
+CDF_EXPORT_CACHE_BYTES = int(float(os.environ.get("SWARMPAL_CDF_EXPORT_CACHE_MB", 256)) * 1024**2)
+
+
+class CdfExportService:
+    """Serialise result leaves to CDF once, and serve them from memory to FileDownload widgets
+
+    Exports are cached by a token identifying the result (see new_token; the dashboards
+    renew theirs whenever their results change), so repeated downloads of the same result
+    are not written again. The cache holds the most recent exports up to max_bytes in
+    total, and no reference to the results themselves.
+    """
+
+    def __init__(self, max_bytes=CDF_EXPORT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # (token, leaf) -> CDF file content
+        self._cache = OrderedDict()
+        self._size = 0
+
+    @staticmethod
+    def new_token():
+        """A new token, to identify a new result"""
+        return uuid.uuid4().hex
+
+    @staticmethod
+    def export(data, leaf):
+        """Write a leaf of a result to CDF, returning the content of the file"""
+        # cdflib will only write to a new file, so write to a fresh directory and read it back
+        with TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "export.cdf")
+            data.swarmpal.to_cdf(filename, leaf=leaf)
+            with open(filename, "rb") as f:
+                return f.read()
+
+    async def get_bytes(self, token, get_data, leaf):
+        """Get the content of the CDF file of a leaf of the result identified by token
+
+        The file is written in a thread, so that the server carries on with other sessions.
+        """
+        key = (token, leaf)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        content = await asyncio.to_thread(self.export, get_data(), leaf)
+        with self._lock:
+            if key not in self._cache and len(content) <= self.max_bytes:
+                self._cache[key] = content
+                self._size += len(content)
+                while self._size > self.max_bytes:
+                    _, dropped = self._cache.popitem(last=False)
+                    self._size -= len(dropped)
+        return content
+
+    def attach(self, file_download, get_token, get_data, leaf, filename):
+        """Serve the export of the result returned by get_data() (identified by get_token()) when file_download is clicked"""
+
+        async def callback():
+            return io.BytesIO(await self.get_bytes(get_token(), get_data, leaf))
+
+        file_download.callback = callback
+        file_download.filename = filename
+
+
+CDF_EXPORTS = CdfExportService()
+
+
+def concat_datatrees(trees, dim="Timestamp"):
+    """Join DataTrees node by node along a dimension (nodes without the dimension are taken from the first tree)"""
+    node_datasets = {}
+    for tree in trees:
+        for node in tree.subtree:
+            node_datasets.setdefault(node.path, []).append(node.to_dataset(inherit=False))
+    joined = {}
+    for path, datasets in node_datasets.items():
+        to_join = [ds for ds in datasets if dim in ds.dims]
+        if len(to_join) > 1:
+            joined[path] = xr.concat(to_join, dim=dim, data_vars="minimal", coords="minimal", compat="override")
+        else:
+            joined[path] = datasets[0]
+    return type(trees[0]).from_dict(joined, name=trees[0].name)
+
+
+def session_user():
+    """Identify the user of the current session (for fair sharing of the compute service)"""
+    if pn.state.user:
+        return pn.state.user
+    if pn.state.curdoc and pn.state.curdoc.session_context:
+        return pn.state.curdoc.session_context.id
+    if pn.state.curdoc:
+        # A document outside the server (e.g. the sessions of benchmarks/load_test.py)
+        return f"document-{id(pn.state.curdoc)}"
+    return "anonymous"
+
+
+async def run_job(job_name, *args, status_pane=None, **kwargs):
+    """Evaluate a job on the compute service and return its result
+
+    Progress is reported in status_pane (optional).
+    Returns None if the job was refused because the queue is full, if it failed, or if the
+    connection to the compute service was lost (the reason is shown in status_pane).
+    """
+    def show_status(status):
+        if status_pane is None:
+            return
+        if status.state == "queued":
+            status_pane.object = f"*Waiting for a free worker (position {status.position + 1} in your queue)...*"
+        else:
+            status_pane.object = "*Evaluating...*"
+
+    service = get_compute_service()
+    try:
+        job_id = await asyncio.to_thread(service.submit, session_user(), job_name, *args, **kwargs)
+        return await wait_for_job(service, job_id, on_status=show_status)
+    except QueueFullError as e:
+        if status_pane is not None:
+            status_pane.object = f"**{e}**"
+    except CONNECTION_ERRORS:
+        # The next job connects again (e.g. to the restarted service)
+        reset_compute_service(service)
+        if status_pane is not None:
+            status_pane.object = "**The connection to the compute service was lost.** Please try again."
+    except (RuntimeError, TimeoutError) as e:
+        if status_pane is not None:
+            status_pane.object = f"**The evaluation failed.** {e}"
+    return None
+
 
 class CustomisedFileDropper(pn.widgets.FileDropper):
     """Custom FileDropper widget to handle file uploads and temporary file creation."""
@@ -63,4 +249,156 @@ class CustomisedFileDropper(pn.widgets.FileDropper):
         file_name, file_content = next(iter(self.value.items()))
         File = namedtuple('File', ['name', 'content'])
         file = File(file_name, file_content)
-        return file
\ No newline at end of file
+        return file
+
+
+class DataTreeTable(pn.viewable.Viewer):
+    """Paginated table of one node of a DataTree
+
+    Only the rows of the current page (and the selected columns) are converted to a
+    DataFrame and sent to the browser, so the size of the results does not drive the
+    weight of the page. Variables with extra dimensions are split into one column per
+    element (e.g. B_NEC -> B_NEC_N, B_NEC_E, B_NEC_C).
+    """
+
+    PAGE_SIZES = [25, 50, 100, 500]
+
+    def __init__(self, page_size=50, max_default_columns=10, **params):
+        super().__init__(**params)
+        self.max_default_columns = max_default_columns
+        self.leaf = pn.widgets.Select(name="Dataset")
+        self.columns = pn.widgets.MultiChoice(name="Columns", sizing_mode="stretch_width")
+        self.page_size = pn.widgets.Select(name="Rows per page", options=self.PAGE_SIZES, value=page_size, width=100)
+        self.page = pn.widgets.IntInput(name="Page", value=1, start=1, end=1, width=100)
+        self.previous_button = pn.widgets.Button(name="Previous", width=80, align="end")
+        self.next_button = pn.widgets.Button(name="Next", width=80, align="end")
+        self.page_info = pn.pane.Markdown(align="end")
+        self.table = pn.widgets.Tabulator(pd.DataFrame(), disabled=True, show_index=False, sizing_mode="stretch_width")
+        self._data = None
+        self._dataset = None
+        self._row_dim = None
+        # Column name -> (variable name, index into the flattened extra dimensions, or None)
+        self._column_sources = {}
+        self._updating = False
+        self.leaf.param.watch(self._on_leaf, "value")
+        self.columns.param.watch(self._on_change, "value")
+        self.page_size.param.watch(self._on_change, "value")
+        self.page.param.watch(self._on_change, "value")
+        self.previous_button.on_click(lambda event: self._turn_page(-1))
+        self.next_button.on_click(lambda event: self._turn_page(1))
+
+    def __panel__(self):
+        return pn.Column(
+            pn.Row(self.leaf, self.columns),
+            pn.Row(self.previous_button, self.page, self.next_button, self.page_size, self.page_info),
+            self.table,
+            sizing_mode="stretch_width",
+        )
+
+    def set_data(self, data, leaf=None):
+        """Show a DataTree, keeping the current selections where they still apply"""
+        self._data = data
+        leaves = [node.path.strip("/") for node in data.subtree if node.has_data]
+        self._updating = True
+        try:
+            self.leaf.options = leaves
+            if leaf in leaves:
+                self.leaf.value = leaf
+            elif self.leaf.value not in leaves:
+                self.leaf.value = leaves[0] if leaves else None
+        finally:
+            self._updating = False
+        self._update_columns()
+        self._refresh()
+
+    def clear(self):
+        self._data = None
+        self._dataset = None
+        self.page_info.object = ""
+        self.table.value = pd.DataFrame()
+
+    def _on_leaf(self, event):
+        if self._updating:
+            return
+        self._update_columns(reset=True)
+        self._refresh()
+
+    def _on_change(self, event):
+        if self._updating:
+            return
+        self._refresh()
+
+    def _turn_page(self, step):
+        self.page.value = min(max(self.page.value + step, self.page.start), self.page.end)
+
+    def _update_columns(self, reset=False):
+        """Identify the rows and columns available in the selected node"""
+        if self._data is None or self.leaf.value is None:
+            self._dataset = None
+            return
+        dataset = self._data[self.leaf.value].to_dataset()
+        self._dataset = dataset
+        # Page through Timestamp if there is one, otherwise through the leading dimension of the data
+        if "Timestamp" in dataset.dims:
+            self._row_dim = "Timestamp"
+        elif dataset.data_vars:
+            self._row_dim = next(iter(dataset.data_vars.values())).dims[0]
+        else:
+            self._row_dim = next(iter(dataset.dims), None)
+        column_sources = {}
+        for name, variable in dataset.data_vars.items():
+            if not variable.dims or variable.dims[0] != self._row_dim:
+                continue
+            if variable.ndim == 1:
+                column_sources[name] = (name, None)
+            elif variable.ndim == 2 and variable.dims[1] in dataset.coords:
+                for i, label in enumerate(dataset[variable.dims[1]].values):
+                    column_sources[f"{name}_{label}"] = (name, i)
+            else:
+                for i, index in enumerate(np.ndindex(variable.shape[1:])):
+                    column_sources[f"{name}_{'_'.join(str(j) for j in index)}"] = (name, i)
+        self._column_sources = column_sources
+        options = list(column_sources)
+        selected = [] if reset else [column for column in self.columns.value if column in column_sources]
+        self._updating = True
+        try:
+            self.columns.options = options
+            self.columns.value = selected or options[:self.max_default_columns]
+        finally:
+            self._updating = False
+
+    def _page_frame(self, start, stop):
+        """Convert the selected columns of rows [start, stop) into a DataFrame"""
+        dataset = self._dataset.isel({self._row_dim: slice(start, stop)})
+        frame = {}
+        if self._row_dim in dataset.coords:
+            frame[self._row_dim] = dataset[self._row_dim].values
+        flattened = {}
+        for column in self.columns.value:
+            name, index = self._column_sources[column]
+            if index is None:
+                frame[column] = dataset[name].values
+            else:
+                if name not in flattened:
+                    values = dataset[name].values
+                    flattened[name] = values.reshape(values.shape[0], -1)
+                frame[column] = flattened[name][:, index]
+        return pd.DataFrame(frame)
+
+    def _refresh(self):
+        if self._dataset is None or self._row_dim is None:
+            self.clear()
+            return
+        n_rows = self._dataset.sizes[self._row_dim]
+        page_size = self.page_size.value
+        n_pages = max(1, math.ceil(n_rows / page_size))
+        self._updating = True
+        try:
+            self.page.value = min(self.page.value, n_pages)
+            self.page.end = n_pages
+        finally:
+            self._updating = False
+        start = (self.page.value - 1) * page_size
+        stop = min(start + page_size, n_rows)
+        self.page_info.object = f"Rows {start + 1 if n_rows else 0}-{stop} of {n_rows:,} (page {self.page.value} of {n_pages})"
+        self.table.value = self._page_frame(start, stop)
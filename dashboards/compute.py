@@ -0,0 +1,387 @@
+"""
+Shared compute service for the dashboards
+
+Heavy evaluations (fetching from VirES, FAC, MMA) run in a pool of worker processes
+rather than in the panel server, so they do not compete with every other session for
+the server's interpreter. Jobs are queued per user and the users take turns to get the
+next free worker. Each user, and the queue as a whole, has a limit on the number of
+pending jobs.
+
+Run as a separate local service (recommended when serving several users):
+    python dashboards/compute.py [--workers N]
+
+The dashboards connect to it at SWARMPAL_COMPUTE_ADDRESS (default 127.0.0.1:50055),
+authenticating with SWARMPAL_COMPUTE_AUTHKEY, which must be set (to the same secret)
+for both. If it is not set or the service is not running, the dashboards start the
+same pool inside the panel server process instead.
+"""
+
+import argparse
+import asyncio
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+import multiprocessing
+from multiprocessing.managers import BaseManager, BaseProxy
+import os
+from pathlib import Path
+import sys
+import threading
+import uuid
+
+_host, _, _port = os.environ.get("SWARMPAL_COMPUTE_ADDRESS", "127.0.0.1:50055").rpartition(":")
+COMPUTE_ADDRESS = (_host, int(_port))
+# The service runs what its clients send, so there is no default key
+COMPUTE_AUTHKEY = os.environ.get("SWARMPAL_COMPUTE_AUTHKEY", "").encode() or None
+MAX_WORKERS = int(os.environ.get("SWARMPAL_COMPUTE_WORKERS", os.cpu_count() or 1))
+MAX_JOBS_PER_USER = int(os.environ.get("SWARMPAL_COMPUTE_MAX_JOBS_PER_USER", 2))
+MAX_QUEUED_JOBS = int(os.environ.get("SWARMPAL_COMPUTE_MAX_QUEUED_JOBS", 50))
+POLL_INTERVAL = 0.5
+# Jobs taking longer than this (s) are given up on
+JOB_TIMEOUT = float(os.environ.get("SWARMPAL_COMPUTE_JOB_TIMEOUT", 3600))
+
+
+# Jobs (executed in the worker processes)
+
+def fac_from_vires(data_params, process_params):
+    """Fetch data from VirES and apply the FAC single-satellite method"""
+    from swarmpal.io import PalDataItem, create_paldata
+    from swarmpal.toolboxes.fac.processes import FAC_single_sat
+
+    data = create_paldata(PalDataItem.from_vires(**data_params))
+    process = FAC_single_sat(config=process_params)
+    return process(data)
+
+
+def fac_from_file(filename, dataset, process_params):
+    """Load a CDF file, evaluate the CHAOS-Core model locally and apply the FAC single-satellite method"""
+    from swarmpal.experimental import LocalForwardMagneticModel
+    from swarmpal.io import PalDataItem, create_paldata
+    from swarmpal.toolboxes.fac.processes import FAC_single_sat
+
+    data = create_paldata(**{dataset: PalDataItem.from_file(filename, filetype="cdf")})
+    process_local_model = LocalForwardMagneticModel()
+    process_local_model.set_config(
+        dataset=dataset,
+        model_descriptor="CHAOS-Core",
+    )
+    data = process_local_model(data)
+    process = FAC_single_sat(config=process_params)
+    return process(data)
+
+
+def mma_inputs(data_config, local_file=None):
+    """Fetch the MMA inputs from VirES, optionally adding a local file given as (product_name, filename)"""
+    from swarmpal.io import PalDataItem, create_paldata
+
+    data = create_paldata(
+        **{
+            label: PalDataItem.from_vires(**data_params)
+            for label, data_params in data_config.items()
+        }
+    )
+    if local_file:
+        from swarmpal.experimental import LocalForwardMagneticModel
+
+        product_name, filename = local_file
+        data[product_name] = PalDataItem.from_file(filename, filetype="cdf").xarray
+        # (HACK) Subset the data to match the PT25S data cadence
+        data[product_name] = data[product_name].sel(Timestamp=data[product_name].ds["Timestamp"][::25])
+        # Evaluate the CHAOS model locally
+        process_local_model = LocalForwardMagneticModel()
+        process_local_model.set_config(
+            dataset=product_name,
+            model_descriptor="CHAOS-Core",
+        )
+        process_local_model(data)
+    return data
+
+
+def mma_2e(data):
+    """Apply the MMA_SHA_2E process to previously fetched inputs"""
+    from swarmpal_mma.pal_processes import MMA_SHA_2E
+
+    mma_process = MMA_SHA_2E()
+    mma_process.set_config(
+        measurement_varname="B_NEC",
+        model_varname="B_NEC_CHAOS-Core",
+    )
+    return mma_process(data)
+
+
+JOBS = {
+    "fac-from-vires": fac_from_vires,
+    "fac-from-file": fac_from_file,
+    "mma-inputs": mma_inputs,
+    "mma-2e": mma_2e,
+}
+
+
+def _warm_worker(initializer=None):
+    """Import what the jobs need when a worker starts rather than in its first job
+
+    initializer (optional) is then called, e.g. to replace VirES with a stand-in in a load test.
+    """
+    import swarmpal.io  # noqa: F401
+    import swarmpal.toolboxes.fac.processes  # noqa: F401
+
+    if initializer is not None:
+        initializer()
+
+
+# Scheduling
+
+class QueueFullError(RuntimeError):
+    """Raised when a job is refused because a queue-depth limit has been reached"""
+
+
+JobStatus = namedtuple("JobStatus", ["state", "position"])
+
+
+class ComputeService:
+    """Worker pool fed by per-user job queues, served to users in turn"""
+
+    def __init__(
+        self,
+        max_workers=MAX_WORKERS,
+        max_jobs_per_user=MAX_JOBS_PER_USER,
+        max_queued_jobs=MAX_QUEUED_JOBS,
+        worker_initializer=None,
+    ):
+        self.max_workers = max_workers
+        # Called in each worker process when it starts (must be picklable)
+        self.worker_initializer = worker_initializer
+        self.max_jobs_per_user = max_jobs_per_user
+        self.max_queued_jobs = max_queued_jobs
+        # The workers find the jobs by importing this module by name
+        if str(Path(__file__).parent) not in sys.path:
+            sys.path.append(str(Path(__file__).parent))
+        self._executor = self._new_executor()
+        self._lock = threading.RLock()
+        # Pending job ids per user, ordered by whose turn is next
+        self._queues = OrderedDict()
+        self._jobs = {}
+        self._running = 0
+
+    def _new_executor(self):
+        # Use fresh interpreters for the workers rather than forking a multi-threaded server
+        return ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_warm_worker,
+            initargs=(self.worker_initializer,),
+        )
+
+    def _replace_broken_executor(self, executor):
+        """Start a new pool if executor is the current one (call with the lock held)
+
+        A pool whose worker died (e.g. out of memory) refuses all further jobs.
+        The jobs which were running on it fail (see _on_done).
+        """
+        if executor is self._executor:
+            self._executor = self._new_executor()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, user, job_name, *args, **kwargs):
+        """Queue a job for a user, returning its id"""
+        if job_name not in JOBS:
+            raise ValueError(f"Unknown job: {job_name}")
+        with self._lock:
+            n_user_jobs = sum(
+                1 for job in self._jobs.values()
+                if job["user"] == user and job["state"] in ("queued", "running")
+            )
+            if n_user_jobs >= self.max_jobs_per_user:
+                raise QueueFullError(
+                    f"You already have {n_user_jobs} evaluations in progress. Please wait for them to finish."
+                )
+            n_queued = sum(len(queue) for queue in self._queues.values())
+            if n_queued >= self.max_queued_jobs:
+                raise QueueFullError("The server is busy. Please try again in a few minutes.")
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = dict(
+                user=user, name=job_name, args=args, kwargs=kwargs,
+                state="queued", result=None, error=None,
+            )
+            self._queues.setdefault(user, deque()).append(job_id)
+            self._dispatch()
+        return job_id
+
+    def _dispatch(self):
+        """Start queued jobs while there are free workers (call with the lock held)"""
+        while self._running < self.max_workers and self._queues:
+            user, queue = self._queues.popitem(last=False)
+            job_id = queue.popleft()
+            # Send the user to the back of the line so that the others get a turn
+            if queue:
+                self._queues[user] = queue
+            job = self._jobs[job_id]
+            executor = self._executor
+            try:
+                try:
+                    future = executor.submit(JOBS[job["name"]], *job["args"], **job["kwargs"])
+                except BrokenProcessPool:
+                    self._replace_broken_executor(executor)
+                    executor = self._executor
+                    future = executor.submit(JOBS[job["name"]], *job["args"], **job["kwargs"])
+            except Exception as e:
+                job["state"] = "failed"
+                job["error"] = f"{type(e).__name__}: {e}"
+                continue
+            del job["args"], job["kwargs"]
+            job["state"] = "running"
+            self._running += 1
+            future.add_done_callback(partial(self._on_done, job_id, executor))
+
+    def _on_done(self, job_id, executor, future):
+        with self._lock:
+            self._running -= 1
+            job = self._jobs[job_id]
+            # (futures are cancelled when their pool is shut down after breaking)
+            broken = future.cancelled() or isinstance(future.exception(), BrokenProcessPool)
+            if broken:
+                self._replace_broken_executor(executor)
+            if job["state"] == "cancelled":
+                # Nobody is waiting for the result
+                del self._jobs[job_id]
+            elif broken:
+                job["state"] = "failed"
+                job["error"] = "A worker process stopped unexpectedly (it may have run out of memory)"
+            elif future.exception() is not None:
+                job["state"] = "failed"
+                job["error"] = f"{type(future.exception()).__name__}: {future.exception()}"
+            else:
+                job["state"] = "done"
+                job["result"] = future.result()
+            self._dispatch()
+
+    def status(self, job_id):
+        """Get the state of a job, and its position in the user's queue if it is still queued"""
+        with self._lock:
+            job = self._jobs[job_id]
+            position = None
+            if job["state"] == "queued":
+                position = self._queues[job["user"]].index(job_id)
+            return JobStatus(job["state"], position)
+
+    def result(self, job_id):
+        """Collect the result of a finished job, removing it from the service"""
+        with self._lock:
+            job = self._jobs[job_id]
+            if job["state"] not in ("done", "failed"):
+                raise RuntimeError(f"Job {job_id} has not finished (state: {job['state']})")
+            del self._jobs[job_id]
+        if job["state"] == "failed":
+            raise RuntimeError(job["error"])
+        return job["result"]
+
+    def cancel(self, job_id):
+        """Drop a job, discarding its result if it is already running"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            if job["state"] == "queued":
+                queue = self._queues[job["user"]]
+                queue.remove(job_id)
+                if not queue:
+                    del self._queues[job["user"]]
+                del self._jobs[job_id]
+            elif job["state"] == "running":
+                job["state"] = "cancelled"
+            else:
+                del self._jobs[job_id]
+
+
+# Client access
+
+class ComputeManager(BaseManager):
+    pass
+
+
+_service = None
+_service_lock = threading.Lock()
+
+# Raised by the proxy of the compute service when the connection is lost (e.g. the service restarted)
+CONNECTION_ERRORS = (EOFError, ConnectionError)
+
+
+def get_compute_service():
+    """Connect to the compute service, or start a pool in this process if it is not running"""
+    global _service
+    with _service_lock:
+        if _service is None and COMPUTE_AUTHKEY:
+            ComputeManager.register("get_service")
+            manager = ComputeManager(address=COMPUTE_ADDRESS, authkey=COMPUTE_AUTHKEY)
+            try:
+                manager.connect()
+                _service = manager.get_service()
+            except OSError:
+                pass
+        if _service is None:
+            _service = ComputeService()
+    return _service
+
+
+def reset_compute_service(service):
+    """Forget a service whose connection was lost, so that the next call to get_compute_service reconnects"""
+    global _service
+    with _service_lock:
+        if _service is service:
+            _service = None
+        if isinstance(service, BaseProxy):
+            # The proxies share their (per-thread) connections by address: new proxies would reuse the broken ones
+            BaseProxy._address_to_local.pop(service._token.address, None)
+
+
+async def wait_for_job(service, job_id, on_status=None, timeout=JOB_TIMEOUT):
+    """Poll a job until it has finished, returning its result
+
+    on_status (optional) is called with each JobStatus while waiting.
+    The job is cancelled if the waiting task is cancelled, or after timeout (s), raising TimeoutError.
+    The calls to the service are made in a thread, so that other sessions are not held up meanwhile
+    (the result is transferred and unpickled whole).
+    """
+    deadline = asyncio.get_running_loop().time() + timeout
+    try:
+        while True:
+            status = await asyncio.to_thread(service.status, job_id)
+            if status.state in ("done", "failed"):
+                return await asyncio.to_thread(service.result, job_id)
+            if on_status:
+                on_status(status)
+            if asyncio.get_running_loop().time() > deadline:
+                raise TimeoutError(f"The evaluation did not finish within {timeout:g} s")
+            await asyncio.sleep(POLL_INTERVAL)
+    except (asyncio.CancelledError, TimeoutError):
+        try:
+            service.cancel(job_id)
+        except CONNECTION_ERRORS:
+            pass
+        raise
+
+
+def serve(max_workers=MAX_WORKERS, worker_initializer=None):
+    """Run the compute service until interrupted (see ComputeService for worker_initializer)"""
+    if not COMPUTE_AUTHKEY:
+        sys.exit("Set SWARMPAL_COMPUTE_AUTHKEY to a secret shared with the dashboards (e.g. python -c 'import secrets; print(secrets.token_hex(32))')")
+    service = ComputeService(max_workers=max_workers, worker_initializer=worker_initializer)
+    ComputeManager.register("get_service", callable=lambda: service)
+    manager = ComputeManager(address=COMPUTE_ADDRESS, authkey=COMPUTE_AUTHKEY)
+    print(f"SwarmPAL compute service listening on {COMPUTE_ADDRESS[0]}:{COMPUTE_ADDRESS[1]} with {max_workers} workers")
+    manager.get_server().serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the SwarmPAL dashboards compute service")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="Number of worker processes")
+    args = parser.parse_args()
+    serve(max_workers=args.workers)
+
+
+if __name__ == "__main__":
+    # Import by name so that the jobs are pickled as compute.<job> rather than __main__.<job>
+    import compute
+
+    compute.main()
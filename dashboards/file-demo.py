@@ -3,14 +3,12 @@ from collections import namedtuple
 import panel as pn
 from tempfile import NamedTemporaryFile
 from pathlib import Path
-import xarray as xr
 
 from swarmpal.io import PalDataItem, create_paldata
 
 from common import HEADER, JINJA2_ENVIRONMENT
 
 pn.extension('filedropper')
-xr.set_options(display_expand_groups=True, display_expand_attrs=True, display_expand_data_vars=True, display_expand_coords=True)
 
 
 class DataExplorer:
@@ -0,0 +1,145 @@
+"""
+Overview levels of the processed products, for browsing long periods of the outputs
+
+For each level (per minute, hour and day), the min, max, mean and number of the valid
+samples in each bin are kept in <output directory>/overview/<variable>_<level>.bin as
+raw records (OVERVIEW_RECORD), which the dashboards read with numpy.memmap (see
+dashboards/archive.py). They are updated incrementally from each new output file: when
+a file ends part way through a bin, the last bin is merged with the next file's data.
+
+Usage (rebuild the overview from all the output files, from the tasks directory):
+    python overview.py outputs/Sat_A
+"""
+
+import os
+import re
+import shutil
+import sys
+
+import numpy as np
+
+# Bin widths of the levels, finest first (also read by dashboards/archive.py, which imports these definitions)
+OVERVIEW_LEVELS = {
+    "PT1M": np.timedelta64(1, "m"),
+    "PT1H": np.timedelta64(1, "h"),
+    "P1D": np.timedelta64(1, "D"),
+}
+OVERVIEW_RECORD = np.dtype(
+    [("time", "datetime64[ns]"), ("min", "f8"), ("max", "f8"), ("mean", "f8"), ("count", "i8")]
+)
+OVERVIEW_DIRECTORY = "overview"
+# Samples with larger flags are left out (the default thresholds of the FAC dashboard)
+FLAGS_MAX = 1
+OUTPUT_NAMING = r".+_\d{8}T\d{6}_\d{8}T\d{6}_.{4}\.(cdf|CDF)$"
+
+
+def read_samples(filename, variable):
+    """Read the times and valid values of a variable from a product file"""
+    import cdflib
+
+    cdf = cdflib.CDF(filename)
+    times = np.asarray(cdflib.cdfepoch.to_datetime(cdf.varget("Timestamp")), dtype="datetime64[ns]")
+    values = np.asarray(cdf.varget(variable), dtype=float)
+    valid = np.isfinite(values)
+    for flag in ("Flags_F", "Flags_B"):
+        if flag in cdf.cdf_info().zVariables:
+            valid &= cdf.varget(flag) <= FLAGS_MAX
+    return times[valid], values[valid]
+
+
+def bin_samples(times, values, width):
+    """Reduce time-sorted samples to one record per bin of the given width"""
+    if not len(times):
+        return np.empty(0, OVERVIEW_RECORD)
+    width_ns = width.astype("timedelta64[ns]").astype("int64")
+    bins = times.astype("datetime64[ns]").astype("int64") // width_ns
+    starts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+    records = np.empty(len(starts), OVERVIEW_RECORD)
+    records["time"] = (bins[starts] * width_ns).astype("datetime64[ns]")
+    records["min"] = np.minimum.reduceat(values, starts)
+    records["max"] = np.maximum.reduceat(values, starts)
+    records["count"] = np.diff(np.r_[starts, len(values)])
+    records["mean"] = np.add.reduceat(values, starts) / records["count"]
+    return records
+
+
+def merge_records(a, b):
+    """Combine two records of the same bin"""
+    merged = np.empty((), OVERVIEW_RECORD)
+    merged["time"] = a["time"]
+    merged["min"] = min(a["min"], b["min"])
+    merged["max"] = max(a["max"], b["max"])
+    merged["count"] = a["count"] + b["count"]
+    merged["mean"] = (a["mean"] * a["count"] + b["mean"] * b["count"]) / merged["count"]
+    return merged
+
+
+def append_records(path, records):
+    """Add records after those in a level file, merging the first with the last one if they share a bin
+
+    Raises ValueError if the records start before the last bin in the file.
+    """
+    itemsize = OVERVIEW_RECORD.itemsize
+    mode = "r+b" if os.path.exists(path) else "w+b"
+    with open(path, mode) as file:
+        # Drop any incomplete record left by an interrupted update
+        n_existing = os.fstat(file.fileno()).st_size // itemsize
+        file.truncate(n_existing * itemsize)
+        if not len(records):
+            return
+        if n_existing:
+            file.seek((n_existing - 1) * itemsize)
+            last = np.frombuffer(file.read(itemsize), OVERVIEW_RECORD)[0]
+            if records["time"][0] < last["time"]:
+                raise ValueError(f"New records start before the end of {path}")
+            if records["time"][0] == last["time"]:
+                records = records.copy()
+                records[0] = merge_records(last, records[0])
+                file.seek((n_existing - 1) * itemsize)
+        file.write(records.tobytes())
+
+
+def level_path(output_directory, variable, level):
+    return os.path.join(output_directory, OVERVIEW_DIRECTORY, f"{variable}_{level}.bin")
+
+
+def add_file(output_directory, filename, variables=("FAC",)):
+    """Add the data of an output file to the overview levels
+
+    Raises ValueError if the file starts before the data already in the overview.
+    """
+    os.makedirs(os.path.join(output_directory, OVERVIEW_DIRECTORY), exist_ok=True)
+    for variable in variables:
+        times, values = read_samples(filename, variable)
+        order = np.argsort(times, kind="stable")
+        times, values = times[order], values[order]
+        # Finest first: a file out of order is refused before any level is changed
+        for level, width in OVERVIEW_LEVELS.items():
+            append_records(level_path(output_directory, variable, level), bin_samples(times, values, width))
+
+
+def update_overview(output_directory, filename, variables=("FAC",)):
+    """Add a new output file to the overview levels, rebuilding them if it arrives out of order"""
+    try:
+        add_file(output_directory, filename, variables)
+    except ValueError:
+        rebuild_overview(output_directory, variables)
+
+
+def rebuild_overview(output_directory, variables=("FAC",)):
+    """Recreate the overview levels from all the output files in a directory"""
+    shutil.rmtree(os.path.join(output_directory, OVERVIEW_DIRECTORY), ignore_errors=True)
+    filenames = sorted(name for name in os.listdir(output_directory) if re.match(OUTPUT_NAMING, name))
+    for name in filenames:
+        try:
+            add_file(output_directory, os.path.join(output_directory, name), variables)
+        except ValueError as e:
+            # Overlaps the previous file
+            print(f"Skipped {name}: {e}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python overview.py <output-dir>")
+        sys.exit(1)
+    rebuild_overview(sys.argv[1])
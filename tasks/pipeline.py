@@ -0,0 +1,506 @@
+"""
+Products generated continuously by the processor, and the pipeline which feeds them
+
+Each registered product declares the inputs it needs (VirES collections, with their
+measurements and models). For each run, every input collection is fetched once, with
+the union of the measurements and models asked for (so the model is evaluated once),
+over the time window needed by the products using it. The data is then handed to each
+product, which only adds the cost of its own evaluation.
+
+Work in progress is kept in the .in-progress directory of each output directory, and
+only moved to its final name (atomically) once complete, so an output file is never
+seen partly written. Long windows are evaluated in sub-windows, recorded in a
+checkpoint as they complete: after a crash, the next run resumes the same window from
+the first sub-window which was not completed. Files are synced to disk before they are
+renamed, so a completed file or checkpoint survives a power loss as well.
+
+Usage (from the tasks directory):
+    python pipeline.py [product names...]
+
+All registered products are run if none are given (see register_product at the bottom).
+"""
+
+from collections import namedtuple
+import datetime as dt
+import json
+import logging
+import os
+import pickle
+import re
+import sched
+import sys
+import time
+
+import numpy as np
+import xarray as xr
+from swarmpal.io import PalDataItem, create_paldata
+from swarmpal.utils.queries import last_available_time
+
+from overview import update_overview
+from sync import sync_directory
+
+SERVER_URL = "https://vires.services/ows"
+WAIT_TIME = 900
+IN_PROGRESS_DIRECTORY = ".in-progress"
+
+Input = namedtuple("Input", ["collection", "measurements", "models"])
+
+
+class Product:
+    """A product evaluated from some inputs, written to one file per evaluated time window
+
+    Subclasses set name, file_prefix, inputs and leaf, and implement process().
+    """
+
+    name = None
+    # Output files are named <file_prefix>_<start>_<end>_XXXX.cdf
+    file_prefix = None
+    inputs = ()
+    # Node of the processed DataTree written to the output files
+    leaf = None
+    # Wait until at least this much new input data is available
+    min_window = dt.timedelta(0)
+    # Evaluate longer windows in parts of this length, kept as they complete (None: in one go)
+    sub_window = None
+    # Extra input fetched around a window, so that each sub-window can be evaluated with the
+    # sample either side of it (its results are then trimmed back to the sub-window)
+    input_margin = dt.timedelta(0)
+    # Time series variables summarised in the overview levels of the outputs (see overview.py)
+    overview_variables = ()
+
+    def __init__(self, output_directory, remote_directory=None):
+        self.output_directory = output_directory
+        self.remote_directory = remote_directory
+
+    @property
+    def collections(self):
+        return [item.collection for item in self.inputs]
+
+    @property
+    def product_naming(self):
+        return rf"{self.file_prefix}_(\d{{8}}T\d{{6}})_(\d{{8}}T\d{{6}})_.{{4}}\.(cdf|CDF)$"
+
+    @property
+    def in_progress_directory(self):
+        return os.path.join(self.output_directory, IN_PROGRESS_DIRECTORY)
+
+    @property
+    def checkpoint_name(self):
+        return os.path.join(self.in_progress_directory, f"{self.name}.json")
+
+    def get_latest_evaluated(self) -> "datetime":
+        """Scan the output directory to identify the latest time in the files"""
+        dir_contents = os.listdir(self.output_directory)
+        matches = [re.match(self.product_naming, filename) for filename in dir_contents]
+        past_end_times = [dt.datetime.strptime(match.group(2), "%Y%m%dT%H%M%S") for match in matches if match]
+        past_end_times.sort()
+        try:
+            # Add 1 second to convert naming scheme closed bound [a,b] to closed-open [a,b)
+            return past_end_times[-1] + dt.timedelta(seconds=1)
+        except IndexError:
+            raise ValueError("No previous files found")
+
+    def output_name(self, t_start, t_end):
+        """Name of the file for the period [t_start, t_end)"""
+        # Convert from closed-open [a,b) to closed-closed [a,b]
+        t_startend_str = f'{t_start.strftime("%Y%m%dT%H%M%S")}_{(t_end - dt.timedelta(seconds=1)).strftime("%Y%m%dT%H%M%S")}'
+        return f"{self.output_directory}/{self.file_prefix}_{t_startend_str}_XXXX.cdf"
+
+    def sub_windows(self, t_start, t_end):
+        """Split [t_start, t_end) into the parts evaluated one at a time"""
+        if self.sub_window is None:
+            return [(t_start, t_end)]
+        windows = []
+        while t_start < t_end:
+            windows.append((t_start, min(t_start + self.sub_window, t_end)))
+            t_start = t_start + self.sub_window
+        # Join a short remainder to the sub-window before it
+        if len(windows) > 1 and windows[-1][1] - windows[-1][0] < self.sub_window / 2:
+            windows[-2:] = [(windows[-2][0], windows[-1][1])]
+        return windows
+
+    def part_name(self, t_start):
+        """Name of the file holding the evaluated sub-window starting at t_start"""
+        return os.path.join(self.in_progress_directory, f"{self.name}_{t_start.strftime('%Y%m%dT%H%M%S')}.part")
+
+    def load_checkpoint(self):
+        """The window in progress (None if there is none)
+
+        As {"t_start", "t_end", "completed": [sub-window starts], "empty": [those without input data]}
+        """
+        try:
+            with open(self.checkpoint_name) as file:
+                checkpoint = json.load(file)
+        except FileNotFoundError:
+            return None
+        checkpoint["t_start"] = dt.datetime.fromisoformat(checkpoint["t_start"])
+        checkpoint["t_end"] = dt.datetime.fromisoformat(checkpoint["t_end"])
+        checkpoint.setdefault("empty", [])
+        return checkpoint
+
+    def save_checkpoint(self, checkpoint):
+        os.makedirs(self.in_progress_directory, exist_ok=True)
+        with open(f"{self.checkpoint_name}.tmp", "w") as file:
+            json.dump(
+                dict(checkpoint, t_start=checkpoint["t_start"].isoformat(), t_end=checkpoint["t_end"].isoformat()),
+                file,
+                indent=1,
+            )
+        replace_synced(f"{self.checkpoint_name}.tmp", self.checkpoint_name)
+
+    def clear_in_progress(self):
+        """Remove the checkpoint and the parts of the window in progress"""
+        if not os.path.isdir(self.in_progress_directory):
+            return
+        for filename in os.listdir(self.in_progress_directory):
+            if filename.startswith((f"{self.name}_", f"{self.name}.", f"{self.file_prefix}_")):
+                os.remove(os.path.join(self.in_progress_directory, filename))
+
+    def process(self, data):
+        """Evaluate the product from a DataTree holding its inputs, returning the processed DataTree"""
+        raise NotImplementedError
+
+    def trim(self, data, t_start, t_end):
+        """Drop the results outside [t_start, t_end) (from the input margin)"""
+        data[self.leaf] = data[self.leaf].to_dataset().sel(
+            Timestamp=slice(t_start, t_end - dt.timedelta(microseconds=1))
+        )
+        return data
+
+    def merge(self, parts):
+        """Join the processed DataTrees of consecutive sub-windows (only the leaf is joined)"""
+        if len(parts) == 1:
+            return parts[0]
+        data = parts[0].copy()
+        data[self.leaf] = xr.concat([part[self.leaf].to_dataset() for part in parts], dim="Timestamp")
+        return data
+
+    def write(self, data, output_name):
+        data.swarmpal.to_cdf(output_name, leaf=self.leaf)
+
+
+class FacFast(Product):
+    """FAC single-satellite product from FAST MAG LR data"""
+
+    leaf = "PAL_FAC_single_sat"
+    sub_window = dt.timedelta(hours=6)
+    # (the FAC is evaluated between consecutive 1 Hz samples)
+    input_margin = dt.timedelta(seconds=10)
+    overview_variables = ("FAC",)
+
+    def __init__(self, spacecraft, output_directory, remote_directory=None):
+        super().__init__(output_directory, remote_directory)
+        self.spacecraft = spacecraft
+        self.name = f"FAC-FAST-{spacecraft}"
+        self.file_prefix = f"SW_FAST_FAC{spacecraft}TMS_2F"
+        self.inputs = (
+            Input(f"SW_FAST_MAG{spacecraft}_LR_1B", ("B_NEC", "Flags_F", "Flags_B", "Flags_q"), ("CHAOS",)),
+        )
+
+    def process(self, data):
+        from swarmpal.toolboxes.fac.processes import FAC_single_sat
+
+        process = FAC_single_sat(
+            config=dict(
+                dataset=self.collections[0],
+                model_varname="B_NEC_CHAOS",
+                measurement_varname="B_NEC",
+                time_jump_limit=1,
+            )
+        )
+        return process(data)
+
+
+class Mma2E(Product):
+    """MMA_SHA_2E product from FAST MAG LR data of several spacecraft"""
+
+    leaf = "MMA_SHA_2E"
+    # Sampling of the MAG LR data used by MMA (the 1 Hz inputs are subsampled)
+    subsampling = 25
+    min_window = dt.timedelta(days=1)
+
+    def __init__(self, spacecraft, output_directory, remote_directory=None):
+        super().__init__(output_directory, remote_directory)
+        self.spacecraft = spacecraft
+        self.name = f"MMA-2E-{''.join(spacecraft)}"
+        self.file_prefix = f"SW_FAST_MMA_SHA_2E_{''.join(spacecraft)}"
+        self.inputs = tuple(
+            Input(f"SW_FAST_MAG{sc}_LR_1B", ("B_NEC",), ("CHAOS-Core",)) for sc in spacecraft
+        )
+
+    def process(self, data):
+        from swarmpal_mma.pal_processes import MMA_SHA_2E
+
+        for collection in self.collections:
+            data[collection] = data[collection].sel(
+                Timestamp=data[collection].ds["Timestamp"][::self.subsampling]
+            )
+        mma_process = MMA_SHA_2E()
+        mma_process.set_config(
+            measurement_varname="B_NEC",
+            model_varname="B_NEC_CHAOS-Core",
+        )
+        return mma_process(data)
+
+
+PRODUCTS = {}
+
+
+def register_product(product):
+    """Add a product to those run by the pipeline"""
+    PRODUCTS[product.name] = product
+    return product
+
+
+def fetch_inputs(windows):
+    """Fetch each input collection once, given {Input: (t_start, t_end)} with one Input per collection"""
+    return create_paldata(
+        **{
+            item.collection: PalDataItem.from_vires(
+                collection=item.collection,
+                measurements=list(item.measurements),
+                models=list(item.models),
+                start_time=t_start.isoformat(),
+                end_time=t_end.isoformat(),
+                server_url=SERVER_URL,
+                options=dict(asynchronous=False, show_progress=False),
+            )
+            for item, (t_start, t_end) in windows.items()
+        }
+    )
+
+
+def select_inputs(data, product, t_start, t_end):
+    """Extract the part of the fetched data that a product needs for [t_start, t_end)
+
+    With an input margin, the sample either side of the window is included too. Returns
+    None if there are no samples within the window.
+    """
+    selected = {}
+    for collection in product.collections:
+        dataset = data[collection].to_dataset()
+        times = dataset["Timestamp"].values
+        first, stop = np.searchsorted(times, [np.datetime64(t_start, "ns"), np.datetime64(t_end, "ns")])
+        if stop == first:
+            return None
+        if product.input_margin:
+            first, stop = max(first - 1, 0), min(stop + 1, len(times))
+        selected[collection] = dataset.isel(Timestamp=slice(first, stop))
+    return type(data).from_dict(selected)
+
+
+def plan_windows(due):
+    """Merge the inputs of the products due, given {product: (t_start, t_end)}
+
+    Returns {Input: (t_start, t_end)} with one Input per collection, asking for all the
+    measurements and models needed over the time window covering all the products.
+    """
+    merged = {}
+    for product, (t_start, t_end) in due.items():
+        for item in product.inputs:
+            measurements, models, t_s, t_e = merged.get(item.collection, ({}, {}, t_start, t_end))
+            measurements.update(dict.fromkeys(item.measurements))
+            models.update(dict.fromkeys(item.models))
+            merged[item.collection] = (measurements, models, min(t_s, t_start), max(t_e, t_end))
+    return {
+        Input(collection, tuple(measurements), tuple(models)): (t_start, t_end)
+        for collection, (measurements, models, t_start, t_end) in merged.items()
+    }
+
+
+def replace_synced(temporary_name, name):
+    """Rename a completed file to its final name, syncing its contents and then the rename to disk"""
+    with open(temporary_name, "rb") as file:
+        os.fsync(file.fileno())
+    os.replace(temporary_name, name)
+    directory = os.open(os.path.dirname(os.path.abspath(name)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+def check_output(filename, n_records=None):
+    """Check that an output file was written completely: a readable CDF (with n_records records if given)"""
+    import cdflib
+
+    if not os.path.exists(filename):
+        raise RuntimeError(f"{filename} was not written")
+    try:
+        written = len(np.atleast_1d(cdflib.CDF(filename).varget("Timestamp")))
+    except Exception as e:
+        raise RuntimeError(f"{filename} cannot be read back: {e}") from e
+    if n_records is not None and written != n_records:
+        raise RuntimeError(f"{filename} holds {written} records instead of {n_records}")
+
+
+def evaluate_window(product, checkpoint, data, logger):
+    """Evaluate the remaining sub-windows of the window in progress, then commit its output file
+
+    Sub-windows without any input data are recorded as completed and left out of the
+    output. Returns the name of the output file (None if the whole window had no data).
+    """
+    t_start, t_end = checkpoint["t_start"], checkpoint["t_end"]
+    output_name = product.output_name(t_start, t_end)
+    sub_windows = product.sub_windows(t_start, t_end)
+    for s_start, s_end in sub_windows:
+        if s_start.isoformat() in checkpoint["completed"]:
+            continue
+        logger.info(f"{product.name}: evaluating for time period: {s_start} to {s_end}")
+        inputs = select_inputs(data, product, s_start, s_end)
+        if inputs is None:
+            logger.warning(f"{product.name}: no input data from {s_start} to {s_end}")
+            checkpoint["empty"].append(s_start.isoformat())
+        else:
+            part = product.process(inputs)
+            if product.input_margin:
+                part = product.trim(part, s_start, s_end)
+            part_name = product.part_name(s_start)
+            with open(f"{part_name}.tmp", "wb") as file:
+                pickle.dump(part, file)
+            replace_synced(f"{part_name}.tmp", part_name)
+        checkpoint["completed"].append(s_start.isoformat())
+        product.save_checkpoint(checkpoint)
+    # (The output may already have been committed by a run that stopped before clearing the checkpoint)
+    if not os.path.exists(output_name):
+        parts = []
+        for s_start, _ in sub_windows:
+            if s_start.isoformat() in checkpoint["empty"]:
+                continue
+            with open(product.part_name(s_start), "rb") as file:
+                parts.append(pickle.load(file))
+        if not parts:
+            # Nothing to write: the window is tried again (with any data since) on the next run
+            logger.warning(f"{product.name}: no input data from {t_start} to {t_end}")
+            product.clear_in_progress()
+            return None
+        temporary_name = os.path.join(product.in_progress_directory, os.path.basename(output_name))
+        # Left over if a run stopped while writing (and the CDF writers do not overwrite files)
+        if os.path.exists(temporary_name):
+            os.remove(temporary_name)
+        merged = product.merge(parts)
+        product.write(merged, temporary_name)
+        check_output(temporary_name, merged[product.leaf].sizes.get("Timestamp"))
+        replace_synced(temporary_name, output_name)
+        logger.info(f"New data saved: {output_name}")
+    if product.overview_variables:
+        try:
+            update_overview(product.output_directory, output_name, product.overview_variables)
+        except Exception as e:
+            # The overview is behind until it is rebuilt (python overview.py <output-dir>)
+            logger.error(f"{product.name}: failed to update the overview\n{e}")
+    product.clear_in_progress()
+    return output_name
+
+
+def run_pipeline(products, starting_time, logger):
+    """Evaluate the products for the new data available since they were last evaluated
+
+    A window left in progress by an earlier run is completed first (without extending it).
+    Returns the names of the files written.
+    """
+    collections = dict.fromkeys(collection for product in products for collection in product.collections)
+    logger.info("Checking product availability...")
+    available = {}
+    for collection in collections:
+        available[collection] = last_available_time(collection).replace(microsecond=0)
+        logger.info(f"Latest availability for {collection}: {available[collection]}")
+    due = {}
+    for product in products:
+        checkpoint = product.load_checkpoint()
+        if checkpoint is not None:
+            logger.info(
+                f"{product.name}: resuming time period: {checkpoint['t_start']} to {checkpoint['t_end']}"
+                f" ({len(checkpoint['completed'])} sub-windows already evaluated)"
+            )
+            due[product] = checkpoint
+            continue
+        try:
+            t_start = product.get_latest_evaluated()
+        except ValueError:
+            t_start = starting_time
+        t_end = min(available[collection] for collection in product.collections)
+        logger.info(f"{product.name}: latest processed time end point: {t_start}")
+        if t_end - t_start > product.min_window:
+            # Discard anything left from a window that was committed but not cleared
+            product.clear_in_progress()
+            due[product] = dict(t_start=t_start, t_end=t_end, completed=[], empty=[])
+            product.save_checkpoint(due[product])
+    if not due:
+        logger.info("No new data available")
+        return []
+    # Only fetch the inputs for the sub-windows still to be evaluated
+    to_fetch = {}
+    for product, checkpoint in due.items():
+        remaining = [
+            window for window in product.sub_windows(checkpoint["t_start"], checkpoint["t_end"])
+            if window[0].isoformat() not in checkpoint["completed"]
+        ]
+        if remaining:
+            to_fetch[product] = (remaining[0][0] - product.input_margin, remaining[-1][1] + product.input_margin)
+    data = None
+    if to_fetch:
+        windows = plan_windows(to_fetch)
+        for item, (t_start, t_end) in windows.items():
+            logger.info(f"Fetching {item.collection} {list(item.measurements)} with {list(item.models)}: {t_start} to {t_end}")
+        data = fetch_inputs(windows)
+    written = []
+    for product, checkpoint in due.items():
+        try:
+            output_name = evaluate_window(product, checkpoint, data, logger)
+        except Exception as e:
+            # Leave the other products unaffected; this one resumes on the next run
+            logger.error(f"{product.name}: failed to evaluate\n{e}")
+            continue
+        if output_name is not None:
+            written.append(output_name)
+    return written
+
+
+def configure_logging(name="pipeline"):
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+    formatter = logging.Formatter("%(asctime)s - %(levelname)s:%(name)s:%(message)s")
+    for handler in (logging.StreamHandler(), logging.FileHandler(f"logs/{name}.log")):
+        handler.setLevel(logging.INFO)
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+    return logger
+
+
+SCHEDULE = sched.scheduler(time.time, time.sleep)
+
+
+def job(products, starting_time=None, wait_time=WAIT_TIME, logger=None):
+    try:
+        run_pipeline(products, starting_time, logger)
+    except Exception as e:
+        logger.error(f"Pipeline run failed\n{e}")
+    # Bring the remotes up to date (including any earlier uploads which failed)
+    for product in products:
+        if product.remote_directory:
+            sync_directory(product.output_directory, product.remote_directory, logger)
+    logger.info(f"Waiting to check again ({wait_time}s)")
+    SCHEDULE.enter(wait_time, 1, job, (products, starting_time, wait_time, logger))
+
+
+def main(product_names=None):
+    products = [PRODUCTS[name] for name in product_names] if product_names else list(PRODUCTS.values())
+    logger = configure_logging()
+    logger.info(f"Beginning pipeline for: {', '.join(product.name for product in products)}")
+    for product in products:
+        os.makedirs(product.output_directory, exist_ok=True)
+    # Begin 3 days ago for products without previous outputs
+    t0 = dt.datetime.combine(dt.date.today() - dt.timedelta(days=3), dt.time())
+    SCHEDULE.enter(0, 1, job, (products, t0, WAIT_TIME, logger))
+    SCHEDULE.run()
+
+
+register_product(FacFast("A", "outputs/Sat_A", "FAC/TMS/Sat_A"))
+register_product(FacFast("B", "outputs/Sat_B", "FAC/TMS/Sat_B"))
+register_product(FacFast("C", "outputs/Sat_C", "FAC/TMS/Sat_C"))
+register_product(Mma2E(("A", "B"), "outputs/MMA_AB"))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,196 @@
+"""
+Reconcile a local output directory with its remote mirror over FTP
+
+The remote listing is fetched in one MLSD request and compared with the local files by
+size and checksum. Only the files which are missing remotely, differ from what was
+sent, or were regenerated locally are transferred, several at a time. An upload that
+was interrupted is resumed from the size already on the server (REST + STOR).
+
+What has been sent is recorded in a state file in the local directory (see STATE_FILE).
+
+Usage (one-off reconciliation, from the tasks directory):
+    python sync.py outputs/Sat_A FAC/TMS/Sat_A
+"""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from ftplib import FTP
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+
+from dotenv import dotenv_values
+
+# Files to mirror (anything else in the output directory is ignored)
+OUTPUT_NAMING = r".+\.(cdf|CDF)$"
+STATE_FILE = ".sync-state.json"
+MAX_PARALLEL_TRANSFERS = 4
+BLOCKSIZE = 1024 * 1024
+
+
+def get_ftp_server_credentials(env_file="../.env"):
+    env_vars = dotenv_values(env_file)
+    server = env_vars.get("FTP_SERVER")
+    username = env_vars.get("FTP_USERNAME")
+    password = env_vars.get("FTP_PASSWORD")
+    return {"server": server, "username": username, "password": password}
+
+
+def connect(credentials):
+    ftp = FTP(credentials["server"])
+    ftp.login(credentials["username"], credentials["password"])
+    return ftp
+
+
+def get_remote_listing(ftp, remote_directory):
+    """Get the sizes of the files in a remote directory (in one MLSD request) as {filename: size}"""
+    return {
+        name: int(facts["size"])
+        for name, facts in ftp.mlsd(remote_directory, facts=["type", "size"])
+        if facts.get("type") == "file"
+    }
+
+
+def sha256sum(path):
+    checksum = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(BLOCKSIZE), b""):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def load_state(local_directory):
+    try:
+        with open(os.path.join(local_directory, STATE_FILE)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(local_directory, state):
+    """Write the state file, replacing the previous one in a single step"""
+    path = os.path.join(local_directory, STATE_FILE)
+    with open(f"{path}.tmp", "w") as file:
+        json.dump(state, file, indent=1, sort_keys=True)
+    os.replace(f"{path}.tmp", path)
+
+
+def get_local_listing(local_directory, state):
+    """Get the size and checksum of the local files, only re-reading files that have changed"""
+    listing = {}
+    for entry in os.scandir(local_directory):
+        if not entry.is_file() or not re.match(OUTPUT_NAMING, entry.name):
+            continue
+        stat = entry.stat()
+        known = state.get(entry.name, {})
+        if known.get("size") == stat.st_size and known.get("mtime_ns") == stat.st_mtime_ns:
+            checksum = known["sha256"]
+        else:
+            checksum = sha256sum(entry.path)
+        listing[entry.name] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": checksum}
+    return listing
+
+
+def plan_transfers(local, remote, state):
+    """Decide which files to send, as {filename: offset to start sending from}"""
+    transfers = {}
+    for name, info in local.items():
+        remote_size = remote.get(name)
+        known = state.get(name, {})
+        if remote_size == info["size"] and known.get("sent_sha256") == info["sha256"]:
+            # Up to date
+            continue
+        if (
+            remote_size is not None
+            and remote_size < info["size"]
+            and known.get("sending_sha256") == info["sha256"]
+        ):
+            # An interrupted upload of the same content
+            transfers[name] = remote_size
+        else:
+            transfers[name] = 0
+    return transfers
+
+
+def upload(credentials, local_directory, remote_directory, filename, offset=0):
+    """Send one file (from offset onwards), returning the size of the file on the server"""
+    ftp = connect(credentials)
+    try:
+        ftp.cwd(remote_directory)
+        with open(os.path.join(local_directory, filename), "rb") as file:
+            file.seek(offset)
+            ftp.storbinary(f"STOR {filename}", file, blocksize=BLOCKSIZE, rest=offset or None)
+        return ftp.size(filename)
+    finally:
+        ftp.quit()
+
+
+def sync_directory(local_directory, remote_directory, logger, max_parallel=MAX_PARALLEL_TRANSFERS):
+    """Transfer the differences between a local directory and its remote mirror
+
+    Returns the number of files which failed to transfer (they are retried on the next sync).
+    """
+    credentials = get_ftp_server_credentials()
+    state = load_state(local_directory)
+    local = get_local_listing(local_directory, state)
+    try:
+        ftp = connect(credentials)
+        try:
+            remote = get_remote_listing(ftp, remote_directory)
+        finally:
+            ftp.quit()
+    except Exception as e:
+        logger.error(f"Failed to list remote: {remote_directory}\n{e}")
+        return len(local)
+    for name, info in local.items():
+        known = state.setdefault(name, {})
+        known.update(size=info["size"], mtime_ns=info["mtime_ns"], sha256=info["sha256"])
+        # Files found on both sides with no record (e.g. from before the state file existed)
+        # are trusted when their sizes match
+        if "sent_sha256" not in known and remote.get(name) == info["size"]:
+            known["sent_sha256"] = info["sha256"]
+    transfers = plan_transfers(local, remote, state)
+    if not transfers:
+        save_state(local_directory, state)
+        logger.info(f"Remote {remote_directory} is up to date ({len(local)} files)")
+        return 0
+    logger.info(f"Sending {len(transfers)} of {len(local)} files to remote: {remote_directory}")
+    for name in transfers:
+        state[name]["sending_sha256"] = local[name]["sha256"]
+    save_state(local_directory, state)
+    n_failed = 0
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        futures = {
+            executor.submit(upload, credentials, local_directory, remote_directory, name, offset): name
+            for name, offset in transfers.items()
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                remote_size = future.result()
+                if remote_size != local[name]["size"]:
+                    raise IOError(f"Remote size {remote_size} does not match local size {local[name]['size']}")
+            except Exception as e:
+                n_failed += 1
+                logger.error(f"Failed to upload {name} to remote: {remote_directory}\n{e}")
+                continue
+            state[name]["sent_sha256"] = state[name].pop("sending_sha256")
+            save_state(local_directory, state)
+            resumed = f" (resumed from byte {transfers[name]})" if transfers[name] else ""
+            logger.info(f"Successfully uploaded: {name} to remote: {remote_directory}{resumed}")
+    # Forget files that no longer exist locally
+    for name in set(state) - set(local):
+        del state[name]
+    save_state(local_directory, state)
+    return n_failed
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python sync.py <output-dir> <remote-directory>")
+        sys.exit(1)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s:%(name)s:%(message)s")
+    n_failed = sync_directory(sys.argv[1], sys.argv[2], logging.getLogger(__name__))
+    sys.exit(1 if n_failed else 0)